@@ -9,24 +9,31 @@ from argparse import ArgumentDefaultsHelpFormatter
 from argparse import ArgumentParser
 from argparse import FileType
 import backoff
+import collections
 import datetime
 import gc
+import hashlib
+import heapq
 import httplib
 import httplib2
 import json
 import logging
 import mimetypes
+import mmap
 import os
 from pydrive.auth import GoogleAuth, RefreshError
 from pydrive.drive import GoogleDrive
+import Queue
 import random
 import re
 import signal
+import sqlite3
 import socket
 import ssl
-import subprocess
 import sys
+import threading
 import time
+import urlparse
 import warnings
 
 
@@ -39,7 +46,25 @@ CLIENT_SECRET = None
 
 VERSION = "0.8.1"
 PROJ = "gdcp"  # name of this project
-CHUNKSIZE = 2 ** 20 * 64  # 64 MiB chunks
+CHUNKSIZE = 2 ** 20 * 8  # starting chunk size, adapted to throughput
+CHUNK_ALIGN = 2 ** 18  # resumable uploads need multiples of 256 KiB
+CHUNK_MAX = 2 ** 20 * 256  # largest adaptive chunk
+CHUNK_BUDGET = 2 ** 30  # most chunk bytes in flight across all transfers
+CHUNK_SECONDS = 5.0  # adaptive chunks aim to take this long
+STREAM_BUFSIZE = 2 ** 20  # download bytes held in memory at a time
+MULTIPART_SIZE = 2 ** 20 * 5  # largest file uploaded in one request
+BATCH_SIZE = 100  # most calls Drive accepts in one batch request
+GENERATE_IDS = 1000  # most ids files().generateIds reserves at once
+LARGE_FILE = 2 ** 20 * 64  # files at least this big get their own workers
+WORKER_RATE = 2 ** 20 * 8  # bytes per second assumed for one transfer
+FILE_SECONDS = 0.5  # request latency assumed for every file transferred
+QPS = 10.0  # Drive's default quota is 1000 calls per 100 seconds per user
+BURST = 100  # calls allowed at once after a quiet period
+# Partial response mask covering every file resource field gdcp reads. One
+# mask for all commands keeps cached metadata usable by any of them. Full
+# resources are only fetched to print them with list -j.
+FILE_FIELDS = "id,title,mimeType,fileSize,md5Checksum,downloadUrl,parents(id)"
+LIST_FIELDS = "nextPageToken,items(%s)" % FILE_FIELDS
 
 
 log = logging.getLogger(PROJ)
@@ -50,7 +75,9 @@ oauth2_util = logging.getLogger("oauth2client.util")
 backoff_log = logging.getLogger('backoff')
 
 class Gdcp(object):
-    def __init__(self, drive, excludes=None, include=False, exclude_folders=False):
+    def __init__(self, drive, excludes=None, include=False, exclude_folders=False,
+        jobs=1, segments=1, cache=None, sync=False, full_metadata=False,
+        chunks=None, http_pool=None, quiet=False, multipart_size=MULTIPART_SIZE):
         self.drive = drive
         if not excludes:
             excludes = []
@@ -60,12 +87,100 @@ class Gdcp(object):
         # By default rules only apply to files
         self.exclude_folders = exclude_folders
 
+        # Number of files to transfer at once
+        self.jobs = max(jobs, 1)
+        # Number of byte ranges of one large file to download at once
+        self.segments = max(segments, 1)
+        # ChunkSizer shared by all transfers
+        if chunks is None:
+            chunks = ChunkSizer()
+        self.chunks = chunks
+        # Files up to this size are uploaded with their metadata in one
+        # multipart request instead of a resumable session
+        self.multipart_size = multipart_size
+        # DownloadStream of each thread, reused across files
+        self._streams = threading.local()
+        # Authorized httplib2.Http objects for worker threads
+        if http_pool is None:
+            http_pool = HttpPool(drive.auth.Get_Http_Object)
+        self.http_pool = http_pool
+        # Don't print transfer progress or created folders
+        self.quiet = quiet
+
+        # MetadataCache for Drive file metadata, or None
+        self.cache = cache
+        # DriveIndex that answers folder listings without API calls, or None
+        self.index = None
+        # Folder ids by parent id and title, from listings and mkdir
+        self.paths = PathCache()
+        # Fetch full file resources instead of FILE_FIELDS
+        self.full_metadata = full_metadata
+        # fields parameters for files().get and files().list, None for full
+        # resources
+        if full_metadata:
+            self.get_fields = None
+            self.list_fields = None
+        else:
+            self.get_fields = FILE_FIELDS
+            self.list_fields = LIST_FIELDS
+        # Only transfer files that are new or differ by size or MD5, reusing
+        # existing files and folders with the same title
+        self.sync = sync
+        # FolderPlan of the folders of a parallel upload, None otherwise
+        self.folders = None
+
+        # Guards counts and failures, which worker threads update
+        self.lock = threading.Lock()
         self.file_count = 0
+        self.bytes_transferred = 0
+        self.skipped_count = 0
+        self.bytes_skipped = 0
         self.failures = {"HTTP": [], "MD5": []}
 
         # https://developers.google.com/resources/api-libraries/documentation/drive/v2/python/latest/drive_v2.about.html
         #self.about = drive.auth.service.about().get().execute()
 
+    def worker_pool(self, size=None):
+        """
+        Return a WorkerPool of size workers, self.jobs by default, that each
+        check an authorized httplib2.Http object out of self.http_pool for
+        their requests, because the one shared by drive.auth.service is not
+        thread-safe
+        """
+        return WorkerPool(size or self.jobs, init=self.http_pool.use,
+            finish=self.http_pool.release)
+
+    def download_stream(self):
+        """
+        Return the calling thread's DownloadStream
+        """
+        stream = getattr(self._streams, "stream", None)
+        if stream is None:
+            stream = DownloadStream(self.drive.auth.credentials)
+            self._streams.stream = stream
+        return stream
+
+    def report(self, msg):
+        """
+        Print msg about a transfer unless quiet
+        """
+        if not self.quiet:
+            stdoutn(msg)
+
+    def count_file(self, nbytes=0):
+        with self.lock:
+            self.file_count += 1
+            self.bytes_transferred += nbytes
+
+    def count_skipped(self, nbytes):
+        with self.lock:
+            self.skipped_count += 1
+            self.bytes_skipped += nbytes
+
+    def add_failure(self, kind, f):
+        with self.lock:
+            self.failures[kind].append(f)
+
     def failed(self):
         return bool(len(self.failures["HTTP"]) or len(self.failures["MD5"]))
 
@@ -83,83 +198,717 @@ class Gdcp(object):
             stdoutn("%i files failed MD5 verification:\n%s" %
                         (len(self.failures["MD5"]), failures))
 
-    def upload(self, paths=None, title=None, parent="root", checksum=True):
+    def upload(self, paths=None, title=None, parent="root", checksum=True,
+        pending=None, new_parent=False):
+        """
+        Upload files/folders in paths to folder parent. new_parent is True if
+        parent was created by this upload, so it has nothing to sync against.
+
+        With more than one job the folder tree is walked first, collecting
+        file uploads in pending. Recursive calls for subfolders pass pending
+        along. Then pending file uploads are run by a TransferScheduler.
+        Unless syncing, folders get ids reserved during the walk and are
+        created by a FolderPlan while the files upload, each file waiting
+        for its folder.
+        """
         if not paths:
             paths = []
         if len(paths) > 1:
             title = None  # custom title turned off if more than one file
+        if pending is None and self.cache:
+            # New files and folders appear under parent. Folders below that are
+            # new so have nothing cached.
+            self.cache.invalidate_children(parent)
+        remote = {}
+        if self.sync and not new_parent:
+            # Existing files and folders in parent, by title
+            for m in self.iter_children(parent):
+                if is_sync_match(m):
+                    remote.setdefault(m["title"], m)
+        start_pool = pending is None and self.jobs > 1
+        if start_pool:
+            pending = []
+            if not self.sync:
+                # Syncing looks inside each existing folder, so it still
+                # creates folders as it walks
+                self.folders = FolderPlan(self)
         for local_file in paths:
             f = GdcpFile(self, path=local_file, parent=parent, checksum=checksum, title=title)
-            f.upload()
+            f.remote = remote.get(f.title)
+            f.upload(pending=pending)
+        if start_pool:
+            creator = None
+            if self.folders:
+                creator = threading.Thread(target=self.http_pool.call,
+                    args=(self.folders.create,))
+                creator.daemon = True
+                creator.start()
+            TransferScheduler(self).run(pending, lambda f, segments: f._upload_task)
+            if creator:
+                creator.join()
+                self.folders = None
+            log.info(self.http_pool.summary())
 
     def download(self, ids=None, checksum=True, root="."):
+        """
+        Download files/folders ids into local folder root.
+
+        The tree is walked as FileRecords. With more than one job, files are
+        collected as PendingDownloads and run by a TransferScheduler, and the
+        GdcpFile of each file is only made when its download starts.
+        """
         if not ids:
             ids = []
+        pending = None
+        if self.jobs > 1:
+            pending = []
         for _id in ids:
-            f = GdcpFile(self, gid=_id, checksum=checksum, root=root)
-            f.download()
+            f = GdcpFile(self, gid=_id)
+            f._ensure_google_file_metadata()
+            self._download_record(FileRecord.from_metadata(f.metadata), root,
+                checksum, pending)
+        if pending is not None:
+            TransferScheduler(self).run(pending, lambda p, segments:
+                self._download_task(p, checksum, segments))
+            log.info(self.http_pool.summary())
+
+    def _download_record(self, r, root, checksum=True, pending=None):
+        """
+        Recursively download FileRecord r into local folder root.
+
+        Files are downloaded now, or appended to pending as PendingDownloads
+        if it's a list. The local path of a pending file is reserved with an
+        empty file and its DownloadState is saved, so that
+        de_duplicate_path_name sees it if a sibling has the same title and an
+        interrupted walk resumes into it instead of making a duplicate.
+        """
+        if not self._passes_excludes(r.title, r.is_folder()):
+            return
+        if r.mimeType.startswith("application/vnd.google-apps.") and not r.is_folder():
+            # Skip Google Apps Docs
+            return
+        if not os.path.exists(root):
+            self._create_local_folder(root)
+
+        if r.is_folder():
+            path = os.path.join(root, r.title)
+            if not self.sync:
+                # When syncing, existing folders are reused
+                path = de_duplicate_path_name(path)
+            if self.sync and os.path.isdir(path):
+                self.report("%s/" % path.rstrip("/"))
+            else:
+                self._create_local_folder(path, r.id)
+                self.count_file()
+            for c in self.child_records(r.id):
+                self._download_record(c, path, checksum, pending)
+        elif pending is not None:
+            state = self._download_state(r, root)
+            if not os.path.exists(state.path):
+                open(state.path, "wb").close()
+                state.save()
+            pending.append(PendingDownload(r, state.path))
+        else:
+            self._download_file(r, self._download_state(r, root), checksum)._download_file()
+
+    def _download_state(self, r, root):
+        """
+        Return DownloadState for downloading FileRecord r into folder root,
+        either saved by an earlier partial download of r to resume, or new
+        for root/title, de-duplicated unless syncing
+        """
+        path = os.path.join(root, r.title)
+        # The earlier download may have been given a de-duplicated name
+        state = DownloadState.find(r, path)
+        if state:
+            log.info("Resuming partial download %s" % state.path)
+            return state
+        if not self.sync:
+            # When syncing, existing files are reused
+            path = de_duplicate_path_name(path)
+        return DownloadState(path, r.id, r.md5Checksum, r.fileSize)
+
+    def _download_file(self, r, state, checksum=True):
+        """
+        Return GdcpFile that downloads FileRecord r to state.path
+        """
+        f = r.to_gdcpfile(self, checksum=checksum, root=os.path.dirname(state.path))
+        f.path = state.path
+        f.download_state = state
+        return f
+
+    def _download_task(self, p, checksum, segments):
+        """
+        Return WorkerPool task that downloads PendingDownload p with segments
+        byte ranges at once. The GdcpFile is made when the task runs, resuming
+        the state saved when p's path was reserved.
+        """
+        def task(http):
+            r = p.record
+            state = DownloadState.load(p.path)
+            if state is None or not state.matches(r):
+                state = DownloadState(p.path, r.id, r.md5Checksum, r.fileSize)
+            f = self._download_file(r, state, checksum)
+            f.segments = segments
+            f._download_task(http)
+        return task
+
+    def _create_local_folder(self, path, gid=None):
+        """
+        Create local folder path for Drive folder gid, or for the root of a
+        download if gid is None
+        """
+        try:
+            os.makedirs(path)
+        except OSError:
+            error("Could not create directory %s. Perhaps it already exists."
+                  % path)
+        if gid is None:
+            log.info("Created folder %s" % path)
+        else:
+            log.info("Created folder %s %s" % (path, gid))
+        if not path.endswith("/"):
+            path += "/"
+        self.report("%s" % path)
+
+    def _passes_excludes(self, title, folder=False):
+        """
+        Check if file title passes exclude rules
+        """
+        if folder and not self.exclude_folders:
+            # By default folders always pass. If exclude_folders is True,
+            # then apply rules even if this is a folder
+            return True
+
+        if self.include:
+            passed = False
+        else:
+            passed = True
+        for regex in self.excludes:
+            if regex.match(title):
+                passed = not passed
+                break
+        return passed
 
     def delete(self, ids=None): #CJK added - called by cli_delete
+        """
+        Delete files in batch requests. Folders are not deleted.
+        """
         if not ids:
             ids = []
+        ids = [find_id(_id) for _id in ids]
+        metadata = self.get_metadata(ids)
+        requests = []
         for _id in ids:
-            f = GdcpFile(self, gid=_id)
-            f.delete()
+            md = metadata.get(_id)
+            if md is None:
+                continue
+            if md["mimeType"] == "application/vnd.google-apps.folder":
+                stdoutn("%s\tFile is a Folder (not deleting)." % _id)
+                continue
+            requests.append((_id, self.drive.auth.service.files().delete(fileId=md["id"])))
+        for _id, response, e in self.execute_batch(requests):
+            if self._report_batch_result(_id, e, "deleted"):
+                self._invalidate_cache(metadata[_id])
 
     def move(self, parent, linkIt, ids=None): #CJK added - called by cli_updateParent
+        """
+        Move (or with linkIt, link) files to folder parent in batch requests.
+        Folders are not moved.
+        """
         if not ids:
             ids = []
+        ids = [find_id(_id) for _id in ids]
+        metadata = self.get_metadata(ids)
+        requests = []
         for _id in ids:
-            f = GdcpFile(self, gid=_id)
-            f.move(parent,linkIt)
+            md = metadata.get(_id)
+            if md is None:
+                continue
+            if md["mimeType"] == "application/vnd.google-apps.folder":
+                stdoutn("%s\tFile is a Folder (not moving)." % _id)
+                continue
+            request = self._move_request(md, parent, linkIt)
+            if request is None:
+                stdoutn("%s\tUnable to acquire current parent list (not moving)." % _id)
+                continue
+            requests.append((_id, request))
+        for _id, response, e in self.execute_batch(requests):
+            if self._report_batch_result(_id, e, "linked" if linkIt else "moved"):
+                self._invalidate_cache(metadata[_id], parent)
 
     def copy(self, parent, copy_name, ids=None): #CJK added - called by cli_copy
+        """
+        Copy files to copy_name in folder parent in batch requests. A copy is
+        only made if parent doesn't already have a file named copy_name.
+        Folders are not copied.
+        """
         if not ids:
             ids = []
+        if not copy_name:
+            print("No name specified for copied file (not copying)")
+            return
+        self.copy_manifest([(_id, copy_name, parent) for _id in ids])
+
+    def copy_manifest(self, manifest):
+        """
+        Copy files in batch requests for each (id, new name, parent folder)
+        in manifest. A copy is only made if its parent doesn't already have a
+        file with its new name. Folders are not copied.
+        """
+        manifest = [(find_id(_id), name, find_id(parent)) for _id, name, parent in manifest]
+        metadata = self.get_metadata(unique([_id for _id, name, parent in manifest]))
+        manifest = [(_id, name, parent) for _id, name, parent in manifest
+                    if _id in metadata and
+                    metadata[_id]["mimeType"] != "application/vnd.google-apps.folder"]
+        existing = self.existing_titles(unique([(parent, name) for _id, name, parent in manifest]))
+        requests = []
+        for _id, name, parent in manifest:
+            if (parent, name) in existing:
+                stdoutn("%s\t%s already exists (not copying)" % (_id, name))
+                continue
+            existing.add((parent, name))
+            # Copies go straight into parent rather than the original's folders
+            body = {"title": name, "parents": [{"id": parent}]}
+            request = self.drive.auth.service.files().copy(fileId=_id, body=body,
+                fields=self.get_fields)
+            requests.append((_id, request))
+        for _id, response, e in self.execute_batch(requests):
+            if self._report_batch_result(_id, e, "copied"):
+                self._invalidate_cache(response)
+
+    def existing_titles(self, titles):
+        """
+        Return the set of (parent id, title) in titles for which folder parent
+        has a file (not a folder) with that title. Each pair is checked with
+        a title query in batch requests rather than by listing parent.
+        """
+        requests = []
+        for parent, title in titles:
+            query = ("title = '%s' and '%s' in parents and trashed = false and "
+                     "mimeType != 'application/vnd.google-apps.folder'" %
+                     (query_escape(title), query_escape(parent)))
+            request = self.drive.auth.service.files().list(q=query,
+                maxResults=1, fields="items(id)")
+            requests.append(((parent, title), request))
+        existing = set()
+        for key, response, e in self.execute_batch(requests):
+            if e:
+                # Assume it exists rather than risk a duplicate
+                log.warning("Checking for %s in %s failed: %s" %
+                    (key[1], key[0], describe_error(e)))
+                existing.add(key)
+            elif response["items"]:
+                existing.add(key)
+        return existing
+
+    def get_metadata(self, ids):
+        """
+        Return dict of ID -> file metadata for ids, fetched in batch requests.
+        IDs whose metadata can't be fetched are reported and left out.
+        """
+        metadata = {}
+        requests = []
         for _id in ids:
-            f = GdcpFile(self, gid=_id)
-            f.copy(parent,copy_name)
+            md = None
+            if self.cache:
+                md = self.cache.get(_id, full=self.full_metadata)
+            if md:
+                metadata[_id] = md
+            else:
+                requests.append((_id, self.drive.auth.service.files().get(
+                    fileId=_id, fields=self.get_fields)))
+        for _id, response, e in self.execute_batch(requests):
+            if e:
+                self._report_batch_result(_id, e)
+            else:
+                metadata[_id] = response
+                if self.cache:
+                    self.cache.put(response, alias=_id, full=self.full_metadata)
+        return metadata
+
+    def execute_batch(self, requests):
+        """
+        Execute list of (key, request) in batch requests. Return list of
+        (key, response, exception) in the same order.
+        """
+        return execute_batch(self.drive.auth.service, requests)
+
+    def _move_request(self, metadata, parent, linkIt):
+        """
+        Return request to move (or link) file with metadata to folder parent,
+        or None if its current parents aren't known.
+        """
+        parlist = ",".join([str(p["id"]) for p in metadata.get("parents", [])])
+        if not parlist:
+            return None
+        if linkIt:
+            return self.drive.auth.service.files().update(fileId=metadata["id"],
+                addParents=parent)
+        return self.drive.auth.service.files().update(fileId=metadata["id"],
+            addParents=parent, removeParents=parlist)
+
+    def _report_batch_result(self, _id, e, done=None):
+        """
+        Print the result of a batched operation on _id. Return True if it
+        succeeded.
+        """
+        if e:
+            log.warning("%s failed: %s" % (_id, describe_error(e)))
+            stdoutn("%s\t%s" % (_id, describe_error(e)))
+            return False
+        if done:
+            log.info("%s %s" % (_id, done))
+            stdoutn("%s\t%s" % (_id, done))
+        return True
+
+    def _invalidate_cache(self, metadata, *folders):
+        """
+        Drop cached metadata for a changed file, cached listings of its
+        parents and of folders.
+        """
+        parents = [p["id"] for p in metadata.get("parents", [])] + list(folders)
+        self.paths.invalidate(metadata["id"], *parents)
+        if self.cache:
+            self.cache.invalidate(metadata["id"])
+            for p in parents:
+                self.cache.invalidate_children(p)
 
     def mkdir(self, path_name, parent): #CJK added - called by cli_mkdir
+        """
+        Create folder path X/Y/Z under folder parent, reusing folders that
+        already exist. Return the ID of the last folder or None on error.
+        """
+        f = GdcpFile(self, gid=parent)
+        if not f._is_folder():
+            stdoutn("%s\tParent is not a folder" % parent)
+            return None
+        return self._mkdir_path(path_name, f.id)
+
+    def mkdirs(self, path_names, parent):
+        """
+        Create each folder path in path_names under folder parent. Folders
+        shared by several paths are looked up or created once. Print each
+        path with the ID of its last folder.
+        """
+        f = GdcpFile(self, gid=parent)
+        if not f._is_folder():
+            stdoutn("%s\tParent is not a folder" % parent)
+            return
+        for path_name in path_names:
+            stdoutn("%s\t%s" % (path_name, self._mkdir_path(path_name, f.id)))
+
+    def _mkdir_path(self, path_name, parent):
         dirs = path_name.strip().split('/')
         newpar = parent
         for subdir in dirs:
             if subdir == '': #incase someone sent in /subdir string
                 continue
-            f = GdcpFile(self, gid=newpar)
-            newpar = f.mkdir(subdir)
+            newpar = self.make_folder(newpar, subdir)
+        return newpar
+
+    def find_folder(self, parent, title):
+        """
+        Return ID of a folder titled title in folder parent, or None. parent
+        is listed at most once to fill the path cache.
+        """
+        gid = self.paths.get(parent, title)
+        if gid is None and not self.paths.is_listed(parent):
+            for m in self.iter_children(parent):
+                pass
+            gid = self.paths.get(parent, title)
+        return gid
+
+    def iter_children(self, parent, http=None):
+        """
+        Generate metadata for the children of folder parent in the order
+        Drive lists them, as each page of the listing arrives. Folders are
+        added to self.paths, and the listing is cached once every page has
+        been fetched.
+        """
+        items = None
+        if self.index:
+            items = (r.metadata() for r in self.index.list_children(parent))
+        elif self.cache:
+            items = self.cache.get_children(parent, full=self.full_metadata)
+        if items is not None:
+            for i in items:
+                self._add_child_path(parent, i)
+                yield i
+            self.paths.add_listing(parent)
+            return
+        items = []
+        query = "trashed = false and '%s' in parents" % parent
+        request = self.drive.auth.service.files().list(q=query, maxResults=460,
+            fields=self.list_fields)
+        while request != None:
+            response = execute_request(request, http=http)
+            for i in response["items"]:
+                items.append(i)
+                self._add_child_path(parent, i)
+                yield i
+            request = self.drive.auth.service.files().list_next(request, response)
+        self.paths.add_listing(parent)
+        if self.cache:
+            self.cache.put_children(parent, items, full=self.full_metadata)
+
+    def child_records(self, parent, http=None):
+        """
+        Return FileRecords for the children of folder parent sorted by title
+        """
+        if self.index:
+            records = self.index.list_children(parent)
+            for r in records:
+                if r.is_folder():
+                    self.paths.add(parent, r.title, r.id)
+            self.paths.add_listing(parent)
+            return records
+        return sorted([FileRecord.from_metadata(m)
+                       for m in self.iter_children(parent, http)],
+                      key=lambda r: r.title)
+
+    def _add_child_path(self, parent, metadata):
+        if metadata["mimeType"] == "application/vnd.google-apps.folder":
+            self.paths.add(parent, metadata["title"], metadata["id"])
+
+    def make_folder(self, parent, title):
+        """
+        Return ID of folder titled title in folder parent, creating it if it
+        doesn't exist
+        """
+        gid = self.find_folder(parent, title)
+        if gid is not None:
+            return gid
+        body = {
+            "title": title,
+            "parents": [{"id": parent}],
+            "mimeType": "application/vnd.google-apps.folder"
+        }
+        request = self.drive.auth.service.files().insert(body=body)
+        response = execute_request(request)
+        self.paths.add(parent, title, response["id"])
+        # A new folder is empty, no need to list it
+        self.paths.add_listing(response["id"])
+        if self.cache:
+            self.cache.invalidate_children(parent)
+        log.info("Created folder %s %s" % (title, response["id"]))
+        return response["id"]
 
     def list(self, ids=None, json_flag=False, depth=0):
+        """
+        Print listings of ids and, to depth, of the files below them.
+
+        Folders are listed as FileRecords, or as metadata with json_flag.
+        With more than one job the folders of each level of the tree are
+        fetched at once, and the listing is printed when the walk is done.
+        """
         if not ids:
             ids = []
+        pool = None
+        if self.jobs > 1:
+            pool = self.worker_pool()
         for _id in ids:
-            f = GdcpFile(self, gid=_id)
-            f.list(json_flag=json_flag, depth=depth)
+            r = None
+            metadata = None
+            if self.index and not json_flag:
+                r = self.index.get(find_id(_id))
+            if r is None:
+                f = GdcpFile(self, gid=_id)
+                f._ensure_google_file_metadata()
+                r = FileRecord.from_metadata(f.metadata)
+                if json_flag:
+                    metadata = f.metadata
+            if pool:
+                tree = self._fetch_tree(pool, r, json_flag, depth)
+                children = lambda gid: tree.get(gid, [])
+            else:
+                children = lambda gid: self._list_children(gid, json_flag)
+            self._list_tree(r, metadata, json_flag, depth, children=children)
+        if pool:
+            pool.join()
+            log.info(self.http_pool.summary())
+
+    def _list_tree(self, r, metadata=None, json_flag=False, depth=0,
+        predecessors="", children=None):
+        """
+        Print the listing of FileRecord r, or its metadata with json_flag,
+        and the listings below it. children(gid) returns _list_children() of
+        folder gid.
+
+        If depth < -1 do nothing.
+        If depth == -1, only print r.
+        If > -1 print r and if r is a folder list each child with depth - 1.
+        """
+        if depth >= -1:
+            if json_flag:
+                print json.dumps(metadata)
+            else:
+                print listing_line(r.title, r.id, r.mimeType, r.fileSize,
+                    r.md5Checksum, predecessors)
+        if depth >= 0 and r.is_folder():
+            if not predecessors:
+                new_pre = r.title
+            else:
+                new_pre = predecessors + "/" + r.title
+            for c, m in children(r.id):
+                self._list_tree(c, m, json_flag, depth-1, new_pre, children)
+
+    def _list_children(self, gid, json_flag=False, http=None):
+        """
+        Return list of (FileRecord, metadata) for the children of folder gid
+        sorted by title. metadata is None unless json_flag.
+        """
+        if not json_flag:
+            return [(r, None) for r in self.child_records(gid, http)]
+        children = [(FileRecord.from_metadata(m), m)
+                    for m in self.iter_children(gid, http)]
+        return sorted(children, key=lambda c: c[0].title)
+
+    def _fetch_tree(self, pool, r, json_flag=False, depth=0):
+        """
+        Return dict of folder id to _list_children() for the folders down to
+        depth below FileRecord r. The tree is walked breadth first and the
+        folders in a level are fetched at once through WorkerPool pool.
+        """
+        tree = {}
+        def fetch(http, gid):
+            tree[gid] = self._list_children(gid, json_flag, http)
+        level = [r] if r.is_folder() else []
+        remaining = depth
+        while level and remaining >= 0:
+            for f in level:
+                pool.submit(lambda http, gid=f.id: fetch(http, gid))
+            pool.wait()
+            folders = []
+            for f in level:
+                if f.id not in tree:
+                    error("Could not list folder %s %s" % (f.title, f.id))
+                folders.extend(c for c, m in tree[f.id] if c.is_folder())
+            level = folders
+            remaining -= 1
+        return tree
 
     def get_list(self, myid, json_flag=False, depth=0):#CJK added
+        return list(self.iter_list(myid, depth=depth))
+
+    def iter_list(self, myid, depth=0):
         f = GdcpFile(self, gid=myid)
-        lst = f.get_list(depth=depth)
-        return lst
+        return f.iter_list(depth=depth)
 
     def transfer_ownership(self, ids, email):
+        """
+        Transfer ownership of files and folders to email in batch requests.
+        Folder contents are transferred one folder at a time.
+        """
+        ids = [find_id(_id) for _id in ids]
+        metadata = self.get_metadata(ids)
+        requests = []
         for _id in ids:
-            f = GdcpFile(self, gid=_id)
-            f.transfer_ownership(email, root=True)
+            if _id in metadata:
+                # Inserting an ownership permission for the top-level folder
+                # will send an email and place the folder/file in the new owner's
+                # My Drive root folder, unless they already have write permission.
+                body = {"type": "user", "value": email, "role": "owner"}
+                request = self.drive.auth.service.permissions().insert(
+                    fileId=metadata[_id]["id"],
+                    body=body)
+                requests.append((_id, request))
+        for _id, response, e in self.execute_batch(requests):
+            if self._report_batch_result(_id, e):
+                self._transferred(metadata[_id])
+                if metadata[_id]["mimeType"] == "application/vnd.google-apps.folder":
+                    self._transfer_children(metadata[_id]["id"], email)
+
+    def _transfer_children(self, folder, email):
+        """
+        Transfer ownership of everything below folder to email
+        """
+        children = self.child_records(folder)
+        # First make sure writer permission is inserted. Suppress emails.
+        # If we just insert an ownership permission here first, and there
+        # wasn't already a write permission, the new owner will:
+        # 1) receive an email for every file
+        # 2) the file will be placed in their My Drive root folder. Neither is
+        # desirable.
+        body = {"type": "user", "value": email, "role": "writer"}
+        requests = [(c.id, self.drive.auth.service.permissions().insert(
+                        fileId=c.id,
+                        body=body,
+                        sendNotificationEmails=False))
+                    for c in children]
+        # Now update permission to owner role. Because the new owner
+        # already had write permission an email is not sent and a
+        # reference to the file is not placed in My Drive.
+        body = {"type": "user", "value": email, "role": "owner"}
+        updates = []
+        for _id, response, e in self.execute_batch(requests):
+            if self._report_batch_result(_id, e):
+                updates.append((_id, self.drive.auth.service.permissions().update(
+                    fileId=_id,
+                    permissionId=response["id"],
+                    body=body,
+                    transferOwnership=True)))
+        transferred = set()
+        for _id, response, e in self.execute_batch(updates):
+            if self._report_batch_result(_id, e):
+                transferred.add(_id)
+        for c in children:
+            if c.id in transferred:
+                self._transferred(c.metadata())
+                if c.is_folder():
+                    self._transfer_children(c.id, email)
+
+    def _transferred(self, metadata):
+        self.count_file()
+        stdoutn("%s\t%s" % (metadata["title"], metadata["id"]))
+        log.info("Transferred ownership of %s" % metadata["title"])
 
     def list_all_files(self, json_flag=False):
         """
         Print metadata for all files in Google Drive.
         """
+        for i in self.iter_all_files(fields=self.list_fields):
+            self._list_tree(FileRecord.from_metadata(i), i, json_flag, depth=-1)
+
+    def iter_all_files(self, fields=LIST_FIELDS):
+        """
+        Generate metadata for all files in Google Drive except for trashed.
+        """
         query = "trashed = false"
         log.debug("query = '%s'" % query)
-        request = self.drive.auth.service.files().list(q=query, maxResults=460)
+        request = self.drive.auth.service.files().list(q=query, maxResults=460,
+            fields=fields)
         while request is not None:
             response = execute_request(request)
             for i in response["items"]:
-                g = GdcpFile(self, metadata=i)
-                g.print_file(json_flag=json_flag)
+                yield i
             request = self.drive.auth.service.files().list_next(request, response)
 
+    def build_index(self):
+        """
+        Index all files in Google Drive with one flat listing. Later folder
+        listings are answered from the index.
+        """
+        t0 = time.time()
+        self.index = DriveIndex.build(self)
+        log.info("Indexed %i files in %.02fs" %
+            (len(self.index.records), time.time() - t0))
+
+    def sizes(self, ids):
+        """
+        Print title, id, file count and total bytes of files below each ID
+        from the index. Google Docs have no size and aren't counted.
+        """
+        if self.index is None:
+            self.build_index()
+        for _id in ids:
+            r = self.index.get(find_id(_id))
+            if r is None:
+                stdoutn("%s\tnot found" % _id)
+                continue
+            count, nbytes = self.index.size(r.id)
+            stdoutn("%s\t%s\t%i\t%i" % (remove_r_n(r.title), r.id, count, nbytes))
+
 class GdcpFile(object):
 
     def __init__(self, gdcp, gid=None, path=None, title=None, parent=None,
@@ -190,7 +939,6 @@ class GdcpFile(object):
 
         self._metadata = None
         self.doctype = None
-        self.metadata = metadata
 
         self.retry_limit = 6
         self.bytes_sent = 0
@@ -201,12 +949,28 @@ class GdcpFile(object):
         self.google_md5Checksum = None
         self.local_md5Checksum = None
         self.downloadUrl = None
-
-
-    def upload(self):
+        self.metadata = metadata # last, the setter fills in attributes reset above
+
+        # DownloadState for the file being downloaded to self.path
+        self.download_state = None
+        # Metadata of the Drive file with this title in self.parent when
+        # syncing an upload, or None
+        self.remote = None
+        # httplib2.Http object for transfers, None to use the shared one
+        self.http = None
+        self.progress = FileProgress(buffered=gdcp.jobs > 1, quiet=gdcp.quiet)
+        # Byte ranges to download at once, 1 for files in TransferScheduler's
+        # small lane
+        self.segments = gdcp.segments
+
+    def upload(self, pending=None):
         """
         Recursively upload a file/folder (self.path) to a Google Drive parent
         folder whose ID is self.parent.
+
+        If pending is a list, files are appended to pending to be uploaded
+        later by Gdcp.upload's TransferScheduler. Folders are created now,
+        or added to gdcp.folders to be created later if it's set.
         """
         if self.incomplete:
             self._fail_upload()
@@ -223,321 +987,455 @@ class GdcpFile(object):
 
         if self._is_folder():
             # Folder
-            self._create_google_folder()
-            self.gdcp.file_count += 1
+            new_folder = True
+            if self.remote and self.remote["mimeType"] == "application/vnd.google-apps.folder":
+                # Syncing into a folder that's already there
+                self.metadata = self.remote
+                self.gdcp.report("%s/" % self.path.rstrip("/"))
+                log.info("Using existing folder %s %s" % (self.title, self.id))
+                new_folder = False
+            elif pending is not None and self.gdcp.folders:
+                self.gdcp.folders.add(self)
+            else:
+                self._create_google_folder()
+                self.gdcp.count_file()
             allfiles = path_join(self.path, os.listdir(self.path))
-            self.gdcp.upload(paths=allfiles, parent=self.id, checksum=self.check_checksum)
+            self.gdcp.upload(paths=allfiles, parent=self.id, checksum=self.check_checksum,
+                pending=pending, new_parent=new_folder)
+        elif pending is not None:
+            # File, uploaded later by a worker thread
+            pending.append(self)
         else:
             # File
-            media_body = self._create_media_body()
-            body = self._create_body()
-            t0 = datetime.datetime.now()
-
-            retries = 0
-            complete_retries = 0
-            response = None
-
-            stdoutn("%s" % self.path)
-            stdout("  0.00% 0 0.00MB/s 0s")
-            if self.fileSize == 0:
-                # zero size files don't do resumable chunked uploads
-                request = self.drive.auth.service.files().insert(body=body)
-                while response is None:
-                    try:
-                        response = execute_upload_request(request)
-                    except (apiclient.errors.HttpError, KeyError, ssl.SSLError,
-                            httplib2.HttpLib2Error, httplib.BadStatusLine, socket.error) as e:
-                        # Don't forget that any exceptions caught here should have
-                        # been dealt with in backoff decorators for execute_upload_request
-                        # too
-                        self._fail_upload()
-                        break
-            else:
-                # File is not empty, do resumable chunked upload
-                request = self.drive.auth.service.files().insert(body=body, media_body=media_body)
-                while response is None:
-                    t1 = datetime.datetime.now()
-                    try:
-                        # Attempt to upload one chunk
-                        status, response = request.next_chunk()
-                        if status:
-                            # Successfully sent a chunk, but download not complete yet
-                            # Keep track of progress
-                            prev_bytes_sent = self.bytes_sent
-                            self.bytes_sent = min(self.bytes_sent + CHUNKSIZE, self.fileSize)
-                            cur_progress = status.progress() * 100
-                            t_tmp = datetime.datetime.now()
-                            rate = calc_transfer_rate(t1, t_tmp, CHUNKSIZE)
-                            log.info("Uploaded bytes %i-%i %.02f%% %.02fMB/s" %
-                                (prev_bytes_sent + 1, self.bytes_sent, cur_progress, rate))
-                            stdoutr("  %.02f%% %i %.02fMB/s %s" %
-                                (cur_progress, self.bytes_sent, rate, format_timedelta(t0, t_tmp)))
-                    except (apiclient.errors.HttpError, KeyError, ssl.SSLError,
-                            httplib2.HttpLib2Error, httplib.BadStatusLine, socket.error, socket.timeout) as e:
-                        # Don't forget that any exceptions caught here should have
-                        # been dealt with in backoff decorators for execute_upload_request
-                        # too
-
-                        # Chunk upload threw an error, retry or restart
-
-                        # Create sensible error string
-                        if hasattr(e, "resp"):
-                            err_msg = "%s %i" % (type(e).__name__, e.resp.status)
-                        else:
-                            err_msg = "%s %s" % (type(e).__name__, e)
-
-                        if hasattr(e, "resp") and e.resp.status in [500, 502, 503, 504]:
-                            # Retry this chunk
-                            if retries < self.retry_limit:
-                                log.warning("%s, retrying chunk in %is" % (err_msg, delay(retries)))
-                                time.sleep(delay(retries))
-                                retries += 1
-                            else:
-                                # No more retries left, abort
-                                log.warning("%s, aborting" % err_msg)
-                                self._fail_upload()
-                                break
-                        else:
-                            # Restart upload
-                            if complete_retries < self.retry_limit:
-                                log.warning("%s, restarting upload in %is" % (err_msg, delay(complete_retries)))
-                                time.sleep(delay(complete_retries))
-                                self.bytes_sent = 0
-                                complete_retries += 1
-                                retries = 0
-                                request = self.drive.auth.service.files().insert(body=body, media_body=media_body)
-                            else:
-                                # No more retries left, abort
-                                log.warning("%s, aborting" % err_msg)
-                                self._fail_upload()
-                                break
-
-            self.metadata = response
-            if response:
-                t2 = datetime.datetime.now()
-                rate = calc_transfer_rate(t0, t2, self.fileSize)
-                stdoutr("  %.02f%% %i %.02fMB/s %s" %
-                    (100.00, self.fileSize, rate, format_timedelta(t0, t2)))
-                log.info("Uploaded 100.00%%.  %i bytes in %s %.02fMB/s %s" %
-                    (self.fileSize, format_timedelta(t0, t2), rate, self.id))
-                if self.check_checksum:
-                    self._check_md5()
-            stdoutn()
-            if self.fail_upload_flag or self.fail_md5_flag:
-                log.warning("Upload failed for %s" % self.path)
-                stdoutn("  Upload failed")
-            else:
-                self.gdcp.file_count += 1
+            self._upload_file()
 
         # Do full gc because Python2.7's automatic gc still accumulates more
         # allocated memory than I'd like. Most of the performance hit in this
         # program is network latency so the wall time shouldn't budge
         gc.collect()
 
-    def download(self):
+    def _upload_task(self, http):
         """
-        Recursively download a file/folder to local filesystem starting
-        at self.root.
+        Upload this file from a WorkerPool worker using the worker's http
+        object.
         """
-        # Make sure file metadata is present
-        self._ensure_google_file_metadata()
+        self.http = http
+        try:
+            folders = self.gdcp.folders
+            if folders and not folders.wait(self.parent):
+                log.warning("Not uploading %s, its folder wasn't created" % self.path)
+                self._fail_upload()
+                return
+            self._upload_file()
+        except Exception as e:
+            log.exception("Upload of %s raised %s" % (self.path, e))
+            self._fail_upload()
+            self.progress.newline("  Upload failed")
+            self.progress.flush()
 
-        # Check for match against any exclude rules
-        if not self._passes_excludes():
-            return
+    def _upload_file(self):
+        """
+        Upload a single file at self.path
 
-        # Skip Google Apps Docs
-        if self._is_google_apps_doc():
-            return
+        When syncing, a file that matches self.remote is skipped and one that
+        differs is uploaded as a new revision of self.remote.
+        """
+        if self.remote and self.remote["mimeType"] != "application/vnd.google-apps.folder":
+            if local_matches(self.path, self.remote):
+                log.info("Skipping unchanged %s" % self.path)
+                self.gdcp.count_skipped(self.fileSize)
+                return
+            self.id = self.remote["id"]
+        body = self._create_body()
+        t0 = datetime.datetime.now()
+
+        retries = 0
+        complete_retries = 0
+        response = None
+
+        self.progress.newline("%s" % self.path)
+        self.progress.write("  0.00% 0 0.00MB/s 0s")
+        if self.fileSize == 0:
+            # zero size files don't do resumable chunked uploads
+            request = self._create_upload_request(body)
+            while response is None:
+                try:
+                    response = execute_upload_request(request, http=self._get_http())
+                except (apiclient.errors.HttpError, KeyError, ssl.SSLError,
+                        httplib2.HttpLib2Error, httplib.BadStatusLine, socket.error) as e:
+                    # Don't forget that any exceptions caught here should have
+                    # been dealt with in backoff decorators for execute_upload_request
+                    # too
+                    self._fail_upload()
+                    break
+        elif self.fileSize <= self.gdcp.multipart_size:
+            # Small file, send metadata and contents in one request
+            media_body = self._create_media_body(resumable=False)
+            try:
+                request = self._create_upload_request(body, media_body)
+                response = execute_upload_request(request, http=self._get_http())
+                self.local_md5Checksum = media_body.md5()
+            except (apiclient.errors.HttpError, KeyError, ssl.SSLError,
+                    httplib2.HttpLib2Error, httplib.BadStatusLine, socket.error,
+                    socket.timeout) as e:
+                # Don't forget that any exceptions caught here should have
+                # been dealt with in backoff decorators for execute_upload_request
+                # too
+                log.warning("%s, aborting" % describe_error(e))
+                self._fail_upload()
+            finally:
+                media_body.close()
+        else:
+            # File is not empty, do resumable chunked upload
+            chunks = self.gdcp.chunks.transfer()
+            media_body = self._create_media_body(chunks)
+            request = self._create_upload_request(body, media_body)
+            session = UploadSession(self)
+            if session.load():
+                # Continue an upload session left by an earlier run
+                log.info("Resuming upload of %s from session at byte %i" %
+                    (self.path, session.offset))
+                request.resumable_uri = session.uri
+                resumed, response = self._resume_upload(request, session)
+                if not resumed:
+                    log.info("Upload session of %s is gone, restarting" % self.path)
+                    session.remove()
+                    request = self._create_upload_request(body, media_body)
+            while response is None:
+                # media_body sends chunks of the size reserved here
+                chunks.reserve()
+                t1 = datetime.datetime.now()
+                try:
+                    # Attempt to upload one chunk
+                    rate_limiter.acquire()
+                    status, response = request.next_chunk(http=self._get_http())
+                    if status:
+                        # Successfully sent a chunk, but download not complete yet
+                        # Keep track of progress
+                        prev_bytes_sent = self.bytes_sent
+                        self.bytes_sent = status.resumable_progress
+                        session.save(request.resumable_uri, self.bytes_sent)
+                        cur_progress = status.progress() * 100
+                        t_tmp = datetime.datetime.now()
+                        rate = calc_transfer_rate(t1, t_tmp, self.bytes_sent - prev_bytes_sent)
+                        chunks.done(self.bytes_sent - prev_bytes_sent, t1, t_tmp)
+                        log.info("Uploaded bytes %i-%i %.02f%% %.02fMB/s" %
+                            (prev_bytes_sent + 1, self.bytes_sent, cur_progress, rate))
+                        self.progress.rewrite("  %.02f%% %i %.02fMB/s %s" %
+                            (cur_progress, self.bytes_sent, rate, format_timedelta(t0, t_tmp)))
+                except (apiclient.errors.HttpError, KeyError, ssl.SSLError,
+                        httplib2.HttpLib2Error, httplib.BadStatusLine, socket.error, socket.timeout) as e:
+                    # Don't forget that any exceptions caught here should have
+                    # been dealt with in backoff decorators for execute_upload_request
+                    # too
+
+                    # Chunk upload threw an error, retry or restart
+                    chunks.retried()
+                    if is_rate_limited(e):
+                        rate_limiter.throttle()
+
+                    # Create sensible error string
+                    if hasattr(e, "resp"):
+                        err_msg = "%s %i" % (type(e).__name__, e.resp.status)
+                    else:
+                        err_msg = "%s %s" % (type(e).__name__, e)
+
+                    if hasattr(e, "resp") and e.resp.status in [500, 502, 503, 504]:
+                        # Retry this chunk
+                        if retries < self.retry_limit:
+                            log.warning("%s, retrying chunk in %is" % (err_msg, delay(retries)))
+                            time.sleep(delay(retries))
+                            retries += 1
+                        else:
+                            # No more retries left, abort
+                            log.warning("%s, aborting" % err_msg)
+                            self._fail_upload()
+                            break
+                    else:
+                        # Resume from what the session has committed or, if
+                        # there is no usable session, restart upload
+                        if complete_retries < self.retry_limit:
+                            wait = delay(complete_retries)
+                            complete_retries += 1
+                            retries = 0
+                            if (request.resumable_uri is not None and
+                                    not (hasattr(e, "resp") and e.resp.status in [404, 410])):
+                                log.warning("%s, resuming upload in %is" % (err_msg, wait))
+                                time.sleep(wait)
+                                resumed, response = self._resume_upload(request, session)
+                                if not resumed:
+                                    log.warning("Upload session of %s is gone, restarting" % self.path)
+                                    session.remove()
+                                    self.bytes_sent = 0
+                                    request = self._create_upload_request(body, media_body)
+                            else:
+                                log.warning("%s, restarting upload in %is" % (err_msg, wait))
+                                time.sleep(wait)
+                                session.remove()
+                                self.bytes_sent = 0
+                                request = self._create_upload_request(body, media_body)
+                        else:
+                            # No more retries left, abort
+                            log.warning("%s, aborting" % err_msg)
+                            self._fail_upload()
+                            break
+            chunks.release()
+            if response:
+                # Every byte has been through media_body's MD5 by now
+                self.local_md5Checksum = media_body.md5()
+                session.remove()
+            media_body.close()
 
-        if not os.path.exists(self.root):
-            self._create_local_folder(path=self.root)
+        self.metadata = response
+        if response:
+            t2 = datetime.datetime.now()
+            rate = calc_transfer_rate(t0, t2, self.fileSize)
+            self.progress.rewrite("  %.02f%% %i %.02fMB/s %s" %
+                (100.00, self.fileSize, rate, format_timedelta(t0, t2)))
+            log.info("Uploaded 100.00%%.  %i bytes in %s %.02fMB/s %s" %
+                (self.fileSize, format_timedelta(t0, t2), rate, self.id))
+            if self.check_checksum:
+                self._check_md5()
+        self.progress.newline()
+        if self.fail_upload_flag or self.fail_md5_flag:
+            log.warning("Upload failed for %s" % self.path)
+            self.progress.newline("  Upload failed")
+        else:
+            self.gdcp.count_file(self.fileSize)
+        self.progress.flush()
 
-        self.path = os.path.join(self.root, self.title)
-        self.path = de_duplicate_path_name(self.path)
+    def _download_task(self, http):
+        """
+        Download this file from a WorkerPool worker using the worker's http
+        object.
+        """
+        self.http = http
+        try:
+            self._download_file()
+        except Exception as e:
+            log.exception("Download of %s raised %s" % (self.path, e))
+            self._fail_download()
+            self.progress.newline("  Download failed for %s" % self.path)
+            self.progress.flush()
+
+    def _download_file(self):
+        """
+        Download a single file to self.path
 
-        if self._is_folder():
-            # Folder
-            self._create_local_folder()
-            self.gdcp.file_count += 1
-            children = self._get_children()
-            for f in children:
-                f.root = self.path # reset root to be this file's path
-                f.download()
+        When syncing, a local file that already matches is skipped.
+        """
+        state = self.download_state
+        if self.gdcp.sync and not state.ranges and local_matches(self.path, self.metadata):
+            log.info("Skipping unchanged %s" % self.path)
+            self.gdcp.count_skipped(self.fileSize)
+            state.remove()
+            return
+        self.progress.newline(self.path)
+        self.progress.write("  0.00% 0 0.00MB/s 0s")
+        log.info("Downloading %s, size = %i, md5 = %s, id = %s" %
+            (self.path, self.fileSize, self.google_md5Checksum, self.id))
+
+        t0 = datetime.datetime.now()
+        self.bytes_received = state.bytes_done()
+        if self.segments > 1 and self.fileSize > self.gdcp.chunks.chunksize():
+            self._download_segmented(t0)
         else:
-            # File
-            stdoutn(self.path)
-            stdout("  0.00% 0 0.00MB/s 0s")
-            log.info("Downloading %s, size = %i, md5 = %s, id = %s" %
-                (self.path, self.fileSize, self.google_md5Checksum, self.id))
+            self._download_sequential(t0)
+
+        if not self.fail_download_flag:
+            state.remove()
+        elif state.ranges:
+            # Keep what we have so the next download of this file can resume
+            log.warning("Keeping partial download %s, %i of %i bytes" %
+                (self.path, state.bytes_done(), self.fileSize))
+        else:
+            state.remove()
+            os.remove(self.path)
 
-            t0 = datetime.datetime.now()
-            bytes_start = 0
-            bytes_end = min(max(self.fileSize - 1, 0), CHUNKSIZE - 1)
+        t2 = datetime.datetime.now()
+        rate = calc_transfer_rate(t0, t2, self.bytes_received)
+        try:
+            cur_progress = float(self.bytes_received) / self.fileSize * 100
+        except ZeroDivisionError:
+            cur_progress = 100.00
+        if not self.fail_download_flag:
+            self.progress.rewrite("  %.02f%% %i %.02fMB/s %s" %
+                (cur_progress, self.bytes_received, rate, format_timedelta(t0, t2)))
+            if self.check_checksum:
+                if self.check_checksum:
+                    self._check_md5()
+        self.progress.newline()
+        if self.fail_download_flag or self.fail_md5_flag:
+            log.warning("Download failed for %s" % self.path)
+            self.progress.newline("  Download failed for %s" % self.path)
+        else:
+            rate = calc_transfer_rate(t0, t2, self.fileSize)
+            log.info("Downloaded %.02f%% .  %i bytes in %s %.02fMB/s" %
+                (cur_progress, self.bytes_received, format_timedelta(t0, t2), rate))
+            self.gdcp.count_file(self.fileSize)
+        self.progress.flush()
 
-            with open(self.path, "wb") as fh:
-                while self.bytes_received < self.fileSize:
-                    t1 = datetime.datetime.now()
+    def _download_sequential(self, t0):
+        """
+        Download the missing byte ranges of self.path one at a time
 
+        For a fresh download the MD5 checksum is updated as each range is
+        written so no second pass over the file is needed to verify it. A
+        resumed download is checked by _check_md5 reading the file back.
+        """
+        state = self.download_state
+        md5 = None
+        if not state.ranges:
+            md5 = hashlib.md5()
+
+        chunks = self.gdcp.chunks.transfer()
+        stream = self.gdcp.download_stream()
+        with open(self.path, "r+b" if state.ranges else "wb") as fh:
+            for bytes_start, bytes_end in chunks.ranges(state.missing(self.fileSize)):
+                t1 = datetime.datetime.now()
+
+                try:
+                    log.info("begin dl request for %s at %s" % (self.title, datetime.datetime.now().isoformat()))
+                    response, range_md5 = execute_stream_request(stream,
+                        self.downloadUrl, bytes_start, bytes_end, fh, md5)
+                    log.info("end dl request for %s at %s" % (self.title, datetime.datetime.now().isoformat()))
+                except (httplib.HTTPException, socket.error, socket.timeout) as e:
+                    # Don't forget that any exceptions caught here should have
+                    # been dealt with in backoff decorators for execute_stream_request
+                    # too
+                    self._fail_download()
+                    break
+                finally:
+                    t_tmp = datetime.datetime.now()
+                if response_is_bad([response, range_md5]):
+                    self._fail_download()
+                    break
+                else:
+                    state.record(bytes_start, bytes_end)
+                    md5 = range_md5
+                    self.bytes_received += bytes_end - bytes_start + 1
+                    bytes_this_chunk = bytes_end - bytes_start + 1
+                    chunks.done(bytes_this_chunk, t1, t_tmp)
                     try:
-                        log.info("begin dl request for %s at %s" % (self.title, datetime.datetime.now().isoformat()))
-                        response, content = execute_download_request(self.drive.auth.service._http,
-                            self.downloadUrl, bytes_start, bytes_end)
-                        log.info("end dl request for %s at %s" % (self.title, datetime.datetime.now().isoformat()))
-                    except (httplib.IncompleteRead, httplib.ResponseNotReady, socket.error, socket.timeout, httplib2.HttpLib2Error) as e:
-                        # Don't forget that any exceptions caught here should have
-                        # been dealt with in backoff decorators for execute_download_request
-                        # too
-                        self._fail_download()
-                        fh.close()
-                        os.remove(self.path)
-                        break
-                    if response_is_bad([response, content]):
-                        self._fail_download()
-                        fh.close()
-                        os.remove(self.path)
-                        break
-                    else:
-                        fh.write(content)
-                        self.bytes_received += bytes_end - bytes_start + 1
-                        bytes_this_chunk = bytes_end - bytes_start + 1
-                        try:
-                            cur_progress = float(self.bytes_received) / self.fileSize * 100
-                        except ZeroDivisionError:
-                            cur_progress = 100.00
-                        t_tmp = datetime.datetime.now()
-                        rate = calc_transfer_rate(t1, t_tmp, bytes_this_chunk)
-                        log.info("Downloaded bytes %i-%i with status %s %.02f%% %.02fMB/s" %
-                            (bytes_start, bytes_end, response.status, cur_progress, rate))
-                        stdoutr("  %.02f%% %i %.02fMB/s %s" %
-                            (cur_progress, self.bytes_received, rate, format_timedelta(t0, t_tmp)))
-                        bytes_start = bytes_end + 1
-                        bytes_end = min(max(self.fileSize - 1, 0), bytes_start + CHUNKSIZE - 1)
-
-            t2 = datetime.datetime.now()
-            rate = calc_transfer_rate(t0, t2, self.bytes_received)
-            try:
-                cur_progress = float(self.bytes_received) / self.fileSize * 100
-            except ZeroDivisionError:
-                cur_progress = 100.00
-            if not self.fail_download_flag:
-                stdoutr("  %.02f%% %i %.02fMB/s %s" %
-                    (cur_progress, self.bytes_received, rate, format_timedelta(t0, t2)))
-                if self.check_checksum:
-                    if self.check_checksum:
-                        self._check_md5()
-            stdoutn()
-            if self.fail_download_flag or self.fail_md5_flag:
-                log.warning("Download failed for %s" % self.path)
-                stdoutn("  Download failed for %s" % self.path)
-            else:
-                rate = calc_transfer_rate(t0, t2, self.fileSize)
-                log.info("Downloaded %.02f%% .  %i bytes in %s %.02fMB/s" %
-                    (cur_progress, self.bytes_received, format_timedelta(t0, t2), rate))
-                self.gdcp.file_count += 1
-
-        # Do full gc because Python2.7's automatic gc still accumulates more
-        # allocated memory than I'd like. Most of the performance hit in this
-        # program is network latency so the wall time shouldn't budge
-        gc.collect()
+                        cur_progress = float(self.bytes_received) / self.fileSize * 100
+                    except ZeroDivisionError:
+                        cur_progress = 100.00
+                    rate = calc_transfer_rate(t1, t_tmp, bytes_this_chunk)
+                    log.info("Downloaded bytes %i-%i with status %s %.02f%% %.02fMB/s" %
+                        (bytes_start, bytes_end, response.status, cur_progress, rate))
+                    self.progress.rewrite("  %.02f%% %i %.02fMB/s %s" %
+                        (cur_progress, self.bytes_received, rate, format_timedelta(t0, t_tmp)))
+
+        chunks.release()
+        if md5 and not self.fail_download_flag:
+            self.local_md5Checksum = md5.hexdigest()
+
+    def _download_segmented(self, t0):
+        """
+        Download self.path with self.segments byte ranges in flight at once.
 
-    def delete(self): #CJK added called by gdcp.delete(...)
-        if not self._is_folder():
-            request = self.drive.auth.service.files().delete( fileId=self.id )
-            resp = execute_request(request)
-        else:
-            print("File is a Folder (not deleting).")
-
-    def mkdir(self,subdir): #CJK added called by gdcp.mkdir(...)
-        """
-        Create subdir in this folder if it does not exist
-	Either way return its ID or a negative number on error 
-        """
-        if not subdir:
-            return -2
-        if not self._is_folder():
-            return -1
-        #see if the folder exists first
-        fnames = self.get_list()  #returns list of{'folder': 'true', 'parents': [u'0AMD3WEaqMKIwUk9PVA'], 'id': '1QLtA9z5KiBDa5iNsyW0qN-zWI_kaoZ9irJDgzZc0ZHg', 'name': 'Google Photos'}
-        for f in fnames:
-            if f['folder'] == 'true' and f['name'] == subdir:
-                return f['id']
-        body = {}
-        body["title"] = subdir
-        body["parents"] = [{"id": self.id}]
-        body["mimeType"] = "application/vnd.google-apps.folder"
-        request = self.drive.auth.service.files().insert(body=body)
-        response = execute_request(request)
-        return response["id"]
+        The output file is sized up front and each worker writes its ranges
+        at their offsets through its own file handle, so ranges can complete
+        in any order. Each range keeps the retry/backoff of
+        execute_stream_request. Because ranges arrive out of order the MD5
+        checksum can't be computed inline and _check_md5 reads the file back.
 
-    def copy(self,parent,copy_name): #CJK added called by gdcp.copy(...)
-        #NOTE that the copy is performed ONLY if the file name does NOT exist
-        if not self._is_folder(): #only do this if its a file
-            if not copy_name:
-                print("No name specified for copied file (not copying)")
+        Ranges are the size of one chunk when the download starts and each
+        waits for room in the chunk budget before it's fetched.
+        """
+        state = self.download_state
+        if not state.ranges:
+            with open(self.path, "wb") as fh:
+                fh.truncate(self.fileSize)
+
+        self._segment_lock = threading.Lock()
+        handles = []
+
+        def init():
+            # Python 2 has no os.pwrite, so every worker gets its own file
+            # handle to seek and write without disturbing the others
+            fh = open(self.path, "r+b")
+            handles.append(fh)
+            return fh
+
+        pool = WorkerPool(self.segments, init=init)
+        for bytes_start, bytes_end in state.missing(self.gdcp.chunks.chunksize()):
+            pool.submit(lambda ctx, start=bytes_start, end=bytes_end:
+                self._download_segment(ctx, start, end, t0))
+        pool.join()
+        for fh in handles:
+            fh.close()
+
+    def _download_segment(self, fh, bytes_start, bytes_end, t0):
+        """
+        Download one byte range of self.path from a _download_segmented worker
+        into the worker's file handle fh
+        """
+        if self.fail_download_flag:
+            # Another range already failed, don't bother
+            return
+        nbytes = self.gdcp.chunks.reserve(bytes_end - bytes_start + 1, partial=False)
+        t1 = datetime.datetime.now()
+        try:
+            response, _ = execute_stream_request(self.gdcp.download_stream(),
+                self.downloadUrl, bytes_start, bytes_end, fh)
+        except (httplib.HTTPException, socket.error, socket.timeout) as e:
+            # Don't forget that any exceptions caught here should have
+            # been dealt with in backoff decorators for execute_stream_request
+            # too
+            response = None
+        finally:
+            self.gdcp.chunks.release(nbytes)
+        with self._segment_lock:
+            if self.fail_download_flag:
                 return
-            #only do this if copy_name is not already in the parent folder
-            fnames = self.gdcp.get_list(parent) #returns list of{'folder': 'true', 'parents': [u'0AMD3WEaqMKIwUk9PVA'], 'id': '1QLtA9z5KiBDa5iNsyW0qN-zWI_kaoZ9irJDgzZc0ZHg', 'name': 'Google Photos'}
-            for f in fnames:
-                if f['folder'] == 'false' and f['name'] == copy_name:
-                    print('{} already exists (not copying)'.format(copy_name))
-                    #file with name name is already there, don't add another copy
-                    return
-
-            #make a copy of this (self) file (self.id)
-            copied_file = {'title': copy_name}
-            request = self.drive.auth.service.files().copy( fileId=self.id, body=copied_file )
-            resp = execute_request(request)
-            newID = resp['id']
-            #now move it to the folder passed in (parent), via the gdcp
-            self.gdcp.move(parent, False, [newID])
-
-    def move(self,parent,linkIt): #CJK added called by gdcp.move(...)
-        if not self._is_folder(): #only do this if its a file
-            #get the list of the current parent folders
-            prevpar = self.metadata["parents"]
-            parlist = ""
-            for ele in prevpar:
-                if parlist != "":
-                    parlist += ","
-                parlist += "{}".format(str(ele["id"]))
-            #now move or link the file using the new parent passed in
-            if parlist != "":
-                if linkIt: #link the file to another folder
-                    request = self.drive.auth.service.files().update( fileId=self.id, addParents=parent )
-                else: #move
-                    request = self.drive.auth.service.files().update( fileId=self.id, addParents=parent, removeParents=parlist )
-
-                resp = execute_request(request)
-            else:
-                print("Unable to acquire current parent list (not moving).")
-        else:
-            print("File is a Folder (not moving).")
+            if response is None or response_is_bad([response, None]):
+                self._fail_download()
+                return
+        self.download_state.record(bytes_start, bytes_end)
+        bytes_this_chunk = bytes_end - bytes_start + 1
+        with self._segment_lock:
+            self.bytes_received += bytes_this_chunk
+            cur_progress = float(self.bytes_received) / self.fileSize * 100
+            t_tmp = datetime.datetime.now()
+            rate = calc_transfer_rate(t1, t_tmp, bytes_this_chunk)
+            log.info("Downloaded bytes %i-%i with status %s %.02f%% %.02fMB/s" %
+                (bytes_start, bytes_end, response.status, cur_progress, rate))
+            self.progress.rewrite("  %.02f%% %i %.02fMB/s %s" %
+                (cur_progress, self.bytes_received,
+                 calc_transfer_rate(t0, t_tmp, self.bytes_received),
+                 format_timedelta(t0, t_tmp)))
 
     def get_list(self, depth=0, predecessors=""): #added by CJK
         """
-        Return a list of tuples for each non-folder file below up to depth
+        Return a list of dicts for each file and folder below up to depth,
+        followed by one for this file
+        """
+        return list(self.iter_list(depth, predecessors))
+
+    def iter_list(self, depth=0, predecessors="", seen=None):
+        """
+        Generate the entries of get_list() as folder listing pages arrive.
+        Each id is generated once. seen is the set of ids already generated.
         """
-        lst = []
+        top = seen is None
+        if top:
+            seen = set()
         if depth >= 0:
             if self._is_folder():
-                 children = self._get_children()
-                 for c in children:
-                     if not predecessors:
-                         new_pre = self.title
-                     else:
-                         new_pre = predecessors + "/" + self.title
-                     tmplist = c.get_list(depth-1, new_pre)
-                     #add it to lst if not already there
-                     for tmpele in tmplist:
-                         breakflag = False
-                         for myele in lst:
-                             if tmpele['id'] == myele['id']:
-                                 breakflag = True
-                                 break
-                         if not breakflag: #not found in lst so add it
-                             lst.append(tmpele)
-                          
+                 if not predecessors:
+                     new_pre = self.title
+                 else:
+                     new_pre = predecessors + "/" + self.title
+                 for c in self._iter_children():
+                     for ele in c.iter_list(depth-1, new_pre, seen):
+                         yield ele
+        # this file always ends the top level list
+        if top or self.metadata["id"] not in seen:
+            seen.add(self.metadata["id"])
+            yield self._list_entry()
+
+    def _list_entry(self):
         #add file or folder
         fid = str(self.metadata["id"])
         isFolder = str(self._is_folder()).lower()
@@ -547,309 +1445,1658 @@ class GdcpFile(object):
         for pele in parents:
             plist.append(pele['id'])
         thisele = { "id": fid, "folder": isFolder, "name": fname, "parents": plist }
-        lst.append(thisele)
-        return lst
+        return thisele
 
-    def list(self, json_flag=False, depth=0, predecessors=""):
-        """
-        Print file listings starting at and including self.
+    @property
+    def metadata(self):
+        return self._metadata
 
-        If depth < -1 do nothing.
-        If depth == -1, only print this file.
-        If > -1 print this file and if this is a folder call list on each
-        child with depth - 1.
+    @metadata.setter
+    def metadata(self, response):
         """
-        if depth >= 0:
-            self.print_file(json_flag, predecessors)
-            if self._is_folder():
-                children = self._get_children()
-                for c in children:
-                    if not predecessors:
-                        new_pre = self.title
-                    else:
-                        new_pre = predecessors + "/" + self.title
-                    c.list(json_flag, depth-1, new_pre)
-        elif depth == -1:
-            self.print_file(json_flag, predecessors)
+        Add response for file metadata from Google Drive
+
+        For response keys/values see return object of get()
+        https://developers.google.com/resources/api-libraries/documentation/drive/v2/python/latest/drive_v2.files.html#get
+        """
+        if response:
+            self._metadata = response
+            self.id = response["id"]
+            self.title = response["title"]
+            self.google_md5Checksum = response.get("md5Checksum", None)
+            self.downloadUrl = response.get("downloadUrl", None)
+            self.fileSize = int(response.get("fileSize", 0))
+            self.mimetype = response["mimeType"]
+            if self._is_google_apps_doc():
+                self.doctype = self._get_google_apps_doctype()
+
+    def _iter_children(self):
+        """
+        Generate GdcpFile objects for this file's children in the order Drive
+        lists them, as each page of the listing arrives
+        """
+        for i in self.gdcp.iter_children(self.id, self.http):
+            g = GdcpFile(self.gdcp) # child inherits Gdcp object
+            g.metadata = i
+            g.check_checksum = self.check_checksum # child inherits check_checksum
+            g.root = self.root # child inherits root
+            yield g
+
+    def _ensure_google_file_metadata(self):
+        """
+        Ensure that file metadata from Google is present. Don't perform remote
+        API call if file metadata is already present.
+        """
+        if not self.metadata and self.id:
+            if self.gdcp.index:
+                r = self.gdcp.index.get(self.id)
+                if r:
+                    self.metadata = r.metadata()
+                    return
+            if self.gdcp.cache:
+                response = self.gdcp.cache.get(self.id,
+                    full=self.gdcp.full_metadata)
+                if response:
+                    self.metadata = response
+                    return
+            log.debug("Ensure fired for %s, %s" % (self.id, self.title))
+            gid = self.id
+            request = self.drive.auth.service.files().get(fileId=self.id,
+                fields=self.gdcp.get_fields)
+            response = execute_request(request)
+            self.metadata = response
+            if self.gdcp.cache:
+                # gid may be an alias like "root"
+                self.gdcp.cache.put(response, alias=gid,
+                    full=self.gdcp.full_metadata)
 
-    def print_file(self, json_flag=False, predecessors=""):
+    def _invalidate_cache(self, *folders):
         """
-        Print metadata for this file
+        Drop cached metadata for this file and cached listings of its parents
+        and of folders.
         """
+        self.gdcp._invalidate_cache(self.metadata, *folders)
+
+    def _create_google_folder(self):
+        """
+        Create a folder in Google Drive
+        """
+        body = self._create_body()
+        log.debug("About to create folder %s" % body)
+        request = self.drive.auth.service.files().insert(body=body)
+        response = execute_request(request)
+        # Sometimes folders take a while to become available. Try to get metadata
+        # from Google to make sure it's available before moving on
+        # Skipping here for now, hopefully retries in API calls that use this
+        # folder as a parent will be sufficient to hide errors
+        #request = self.drive.auth.service.files().get(fileId=response["id"])
+        #response = execute_request(request)
+        self._created_google_folder(response)
+
+    def _created_google_folder(self, response):
+        """
+        Record response from the insert of this folder
+        """
+        self.metadata = response
+        path = self.path if self.path else self.title
+        if not path.endswith("/"):
+            path += "/"
+        self.gdcp.report("%s" % path)
+        log.info("Created folder %s %s" % (self.title, self.id))
+
+    def _get_http(self):
+        """
+        Return the httplib2.Http object to use for transfers of this file
+        """
+        if self.http:
+            return self.http
+        http = current_http()
+        if http:
+            return http
+        return self.drive.auth.service._http
+
+    def _is_folder(self):
+        self._ensure_google_file_metadata()
+        return self.mimetype == "application/vnd.google-apps.folder"
+
+    def _is_file(self): #CJK added
+        self._ensure_google_file_metadata()
+        return self.mimetype == "application/vnd.google-apps.file"
+
+    def _is_google_apps_doc(self):
         self._ensure_google_file_metadata()
-        if json_flag:
-            print json.dumps(self.metadata)
+        if self.mimetype.startswith("application/vnd.google-apps."):
+            # Folders are special google apps docs which we consider separately
+            if not self._is_folder():
+                return True
+        return False
+
+    def _get_google_apps_doctype(self):
+        if self._is_google_apps_doc():
+            return self.mimetype.split("application/vnd.google-apps.")[-1]
+
+    def _create_media_body(self, chunks=None, resumable=True):
+        return MmapMediaUpload(self.path, chunks=chunks,
+            resumable=resumable, mimetype=self.mimetype)
+
+    def _resume_upload(self, request, session):
+        """
+        Ask Drive how much of resumable upload request's session it has and
+        continue request from there. Return (resumed, response), resumed
+        False if the session can't be used, and response the file's metadata
+        if the upload was already complete or None.
+        """
+        size = request.resumable.size()
+        try:
+            committed = upload_session_offset(self._get_http(),
+                request.resumable_uri, size)
+        except (apiclient.errors.HttpError, httplib2.HttpLib2Error,
+                httplib.HTTPException, socket.error, socket.timeout) as e:
+            log.warning("Upload session query failed, %s" % describe_error(e))
+            return (False, None)
+        if committed is None:
+            return (False, None)
+        offset, response = committed
+        # next_chunk() sends from resumable_progress, and MmapMediaUpload
+        # serves any offset and still hashes bytes it skips
+        request.resumable_progress = offset
+        self.bytes_sent = offset
+        if response is None:
+            session.save(request.resumable_uri, offset)
+        return (True, response)
+
+    def _create_upload_request(self, body, media_body=None):
+        """
+        Return request to upload a file, as a new revision of file self.id if
+        set or as a new file otherwise.
+        """
+        if self.id:
+            return self.drive.auth.service.files().update(fileId=self.id,
+                body=body, media_body=media_body)
+        return self.drive.auth.service.files().insert(body=body, media_body=media_body)
+
+    def _create_body(self):
+        body = {"title": self.title}
+        if self.mimetype is None:
+            body["mimeType"] = "application/vnd.google-apps.folder"
         else:
-            line = []
-            if predecessors:
-                title = predecessors + "/" + remove_r_n(self.metadata["title"])
-            else:
-                title = remove_r_n(self.metadata["title"])
-            line.append(title)
-            line.append(self.metadata["id"])
-            if self._is_folder():
-                file_type = "folder"
-            elif self._is_google_apps_doc():
-                file_type = self.doctype
+            body["mimeType"] = self.mimetype
+        if self.parent is not None:
+            body["parents"] = [{"id": self.parent}]
+        return body
+
+    def _check_md5(self):
+        """
+        Confirm that response MD5 from Google matches MD5 for local
+        file
+
+        Uses self.local_md5Checksum if it was already computed during the
+        transfer, otherwise reads the local file to compute it.
+        """
+        self.progress.write(" MD5...")
+        if self.local_md5Checksum is None:
+            # Not computed while the file was transferred, read it back
+            log.info("Calculating MD5 checksum for %s" % self.path)
+            try:
+                self.local_md5Checksum = file_md5(self.path)
+            except (OSError, IOError) as e:
+                error("MD5 calculation exited with an error: '%s'" % e)
+        if self.local_md5Checksum == self.google_md5Checksum:
+            self.progress.write("OK")
+            log.info("MD5 OK.  %s (local) == %s" %
+                     (self.local_md5Checksum, self.google_md5Checksum))
+            return True
+        else:
+            self.progress.write("FAIL")
+            log.warning("MD5 failed.  %s (local) != %s" %
+                        (self.local_md5Checksum, self.google_md5Checksum))
+            self._fail_md5()
+            return False
+
+    def _passes_excludes(self):
+        """
+        Check if file title passes exclude rules
+        """
+        return self.gdcp._passes_excludes(self.title, self._is_folder())
+
+    def _fail_md5(self):
+        self.fail_md5_flag = True
+        self.gdcp.add_failure("MD5", self)
+
+    def _fail_upload(self):
+        self.fail_upload_flag = True
+        self.gdcp.add_failure("HTTP", self)
+
+    def _fail_download(self):
+        self.fail_download_flag = True
+        self.gdcp.add_failure("HTTP", self)
+
+
+class MetadataCache(object):
+    """
+    SQLite cache of Drive file metadata and folder listings.
+
+    File metadata is indexed by id and folder listings by parent id, each with
+    the time it was fetched. Entries older than ttl seconds are stale and are
+    fetched again. With ttl == 0 nothing is read or stored but invalidations
+    still apply, so commands that change Drive keep an existing cache honest.
+
+    Entries are flagged full if they hold full file resources rather than
+    FILE_FIELDS. Only full entries satisfy lookups for full metadata.
+    """
+    # Bump when the schema changes. The cache only holds data that can be
+    # fetched again, so an older cache is dropped rather than migrated.
+    schema_version = 2
+
+    def __init__(self, location=None, ttl=0):
+        if not location:
+            location = os.path.join(os.environ["HOME"], "." + PROJ, "metadata.sqlite")
+        self.location = location
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(location, check_same_thread=False)
+        with self.db:
+            version = self.db.execute("PRAGMA user_version").fetchone()[0]
+            if version != self.schema_version:
+                for table in ("files", "children", "listings"):
+                    self.db.execute("DROP TABLE IF EXISTS %s" % table)
+                self.db.execute("PRAGMA user_version = %d" % self.schema_version)
+            self.db.execute("""CREATE TABLE IF NOT EXISTS files (
+                id TEXT PRIMARY KEY, metadata TEXT, fetched REAL, full INTEGER)""")
+            self.db.execute("""CREATE TABLE IF NOT EXISTS children (
+                parent TEXT, child TEXT, PRIMARY KEY (parent, child))""")
+            self.db.execute("""CREATE TABLE IF NOT EXISTS listings (
+                parent TEXT PRIMARY KEY, fetched REAL, full INTEGER)""")
+
+    def _fresh(self):
+        return time.time() - self.ttl
+
+    def get(self, gid, full=False):
+        """
+        Return cached metadata for gid or None if missing or stale, or if
+        full and the cached metadata isn't a full file resource.
+        """
+        if self.ttl <= 0:
+            return None
+        with self.lock:
+            row = self.db.execute("""SELECT metadata FROM files
+                WHERE id = ? AND fetched > ? AND full >= ?""",
+                (gid, self._fresh(), int(full))).fetchone()
+        if row:
+            return json.loads(row[0])
+        return None
+
+    def put(self, metadata, alias=None, full=False):
+        if self.ttl <= 0:
+            return
+        with self.lock, self.db:
+            self._put(metadata, alias, full)
+
+    def _put(self, metadata, alias=None, full=False):
+        row = (json.dumps(metadata), time.time(), int(full))
+        self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+            (metadata["id"],) + row)
+        if alias and alias != metadata["id"]:
+            self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                (alias,) + row)
+
+    def get_children(self, parent, full=False):
+        """
+        Return list of cached metadata for children of parent, or None if
+        the listing or any child is missing or stale, or if full and any of
+        it isn't a full file resource.
+        """
+        if self.ttl <= 0:
+            return None
+        fresh = self._fresh()
+        with self.lock:
+            listed = self.db.execute("""SELECT 1 FROM listings
+                WHERE parent = ? AND fetched > ? AND full >= ?""",
+                (parent, fresh, int(full))).fetchone()
+            if not listed:
+                return None
+            count = self.db.execute(
+                "SELECT COUNT(*) FROM children WHERE parent = ?",
+                (parent,)).fetchone()[0]
+            rows = self.db.execute("""SELECT f.metadata FROM children c
+                JOIN files f ON f.id = c.child
+                WHERE c.parent = ? AND f.fetched > ? AND f.full >= ?""",
+                (parent, fresh, int(full))).fetchall()
+        if len(rows) != count:
+            return None
+        return [json.loads(r[0]) for r in rows]
+
+    def put_children(self, parent, items, full=False):
+        if self.ttl <= 0:
+            return
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM children WHERE parent = ?", (parent,))
+            for i in items:
+                self._put(i, full=full)
+                self.db.execute("INSERT OR REPLACE INTO children VALUES (?, ?)",
+                    (parent, i["id"]))
+            self.db.execute("INSERT OR REPLACE INTO listings VALUES (?, ?, ?)",
+                (parent, time.time(), int(full)))
+
+    def invalidate(self, gid):
+        """
+        Drop cached metadata for gid and its cached listing if a folder.
+        """
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM files WHERE id = ?", (gid,))
+            self.db.execute("DELETE FROM listings WHERE parent = ?", (gid,))
+
+    def invalidate_children(self, parent):
+        """
+        Drop cached listing of folder parent, which may be an alias like
+        "root".
+        """
+        with self.lock, self.db:
+            parents = [parent]
+            row = self.db.execute("SELECT metadata FROM files WHERE id = ?",
+                (parent,)).fetchone()
+            if row:
+                parents.append(json.loads(row[0])["id"])
+            for p in parents:
+                self.db.execute("DELETE FROM listings WHERE parent = ?", (p,))
+
+    def clear(self):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM files")
+            self.db.execute("DELETE FROM children")
+            self.db.execute("DELETE FROM listings")
+
+
+class PathCache(object):
+    """
+    Folder ids by (parent id, title), filled as folders are listed or
+    created, so folder paths resolve without listing each parent again.
+
+    A parent is marked listed once all its children have been seen. Titles
+    missing from a listed parent don't exist. The first folder seen with a
+    title wins, as when looking it up in a listing.
+    """
+    def __init__(self):
+        self.ids = {}  # (parent id, title) -> folder id
+        self.keys = {}  # folder id -> set of (parent id, title)
+        self.listed = set()
+        self.lock = threading.Lock()
+
+    def get(self, parent, title):
+        return self.ids.get((parent, title))
+
+    def add(self, parent, title, gid):
+        with self.lock:
+            key = (parent, title)
+            if key not in self.ids:
+                self.ids[key] = gid
+                self.keys.setdefault(gid, set()).add(key)
+
+    def is_listed(self, parent):
+        return parent in self.listed
+
+    def add_listing(self, parent):
+        with self.lock:
+            self.listed.add(parent)
+
+    def invalidate(self, gid, *parents):
+        """
+        Forget paths to gid and that parents were listed
+        """
+        with self.lock:
+            for key in self.keys.pop(gid, set()):
+                del self.ids[key]
+            for p in parents:
+                self.listed.discard(p)
+
+
+class FileRecord(object):
+    """
+    Compact record of the FILE_FIELDS of a Drive file for listing and
+    planning. fileSize is an int, parents a tuple of ids, and fields Drive
+    didn't return are None.
+
+    A GdcpFile holds many more attributes and the metadata dict, so records
+    are only turned into one with to_gdcpfile() when needed.
+    """
+    __slots__ = ("id", "title", "mimeType", "fileSize", "md5Checksum",
+        "downloadUrl", "parents")
+
+    def __init__(self, gid, title, mimeType, fileSize=None, md5Checksum=None,
+        downloadUrl=None, parents=()):
+        self.id = gid
+        self.title = title
+        self.mimeType = mimeType
+        self.fileSize = fileSize
+        self.md5Checksum = md5Checksum
+        self.downloadUrl = downloadUrl
+        self.parents = parents
+
+    @classmethod
+    def from_metadata(cls, metadata):
+        size = metadata.get("fileSize")
+        return cls(metadata["id"], metadata["title"], metadata["mimeType"],
+            int(size) if size is not None else None, metadata.get("md5Checksum"),
+            metadata.get("downloadUrl"),
+            tuple(p["id"] for p in metadata.get("parents", [])))
+
+    def metadata(self):
+        """
+        Return Drive file metadata for this record, with the keys of
+        FILE_FIELDS
+        """
+        metadata = {"id": self.id, "title": self.title, "mimeType": self.mimeType,
+            "parents": [{"id": p} for p in self.parents]}
+        if self.fileSize is not None:
+            metadata["fileSize"] = str(self.fileSize)
+        if self.md5Checksum is not None:
+            metadata["md5Checksum"] = self.md5Checksum
+        if self.downloadUrl is not None:
+            metadata["downloadUrl"] = self.downloadUrl
+        return metadata
+
+    def to_gdcpfile(self, gdcp, checksum=True, root=None):
+        return GdcpFile(gdcp, checksum=checksum, root=root, metadata=self.metadata())
+
+    def is_folder(self):
+        return self.mimeType == "application/vnd.google-apps.folder"
+
+    def __repr__(self):
+        return "FileRecord(%r, %r, %r)" % (self.id, self.title, self.mimeType)
+
+
+class FolderPlan(object):
+    """
+    Drive folders of an upload, created in batches while files upload.
+
+    add() gives a folder an id reserved with files().generateIds, so the
+    upload can go on to the folder's contents without waiting for Drive to
+    create it. create() inserts the folders with their reserved ids in batch
+    requests one tree level at a time, because a parent must exist before its
+    children, and sets each folder's Event once its level is done. File
+    uploads wait() for their folder's Event.
+
+    Because the ids are fixed, inserts are idempotent. If a retried insert
+    gets 409 the first attempt went through, so the folder is taken as
+    created.
+    """
+    def __init__(self, gdcp):
+        self.gdcp = gdcp
+        self.ids = []  # reserved ids not used yet
+        self.levels = []  # GdcpFiles of folders by depth below the upload
+        self.depths = {}  # depth by folder id
+        self.ready = {}  # Event by folder id, set once created or failed
+        self.failed = set()  # ids of folders that couldn't be created
+
+    def reserve_id(self):
+        if not self.ids:
+            request = self.gdcp.drive.auth.service.files().generateIds(
+                maxResults=GENERATE_IDS, space="drive")
+            self.ids = list(reversed(execute_request(request)["ids"]))
+        return self.ids.pop()
+
+    def add(self, f):
+        """
+        Reserve an id for GdcpFile folder f and plan its creation
+        """
+        f.id = self.reserve_id()
+        depth = self.depths.get(f.parent, -1) + 1
+        self.depths[f.id] = depth
+        if depth == len(self.levels):
+            self.levels.append([])
+        self.levels[depth].append(f)
+        self.ready[f.id] = threading.Event()
+
+    def wait(self, parent):
+        """
+        Wait until folder parent has been created. Return False if it
+        couldn't be.
+        """
+        event = self.ready.get(parent)
+        if event is None:
+            # Not created by this upload
+            return True
+        event.wait()
+        return parent not in self.failed
+
+    def create(self):
+        try:
+            for level in self.levels:
+                self._create_level(level)
+        finally:
+            # Never leave an upload waiting, e.g. if a batch raised
+            for gid, event in self.ready.items():
+                if not event.is_set():
+                    self.failed.add(gid)
+                    event.set()
+
+    def _create_level(self, level):
+        requests = []
+        for f in level:
+            if f.parent in self.failed:
+                self._fail(f)
+                continue
+            body = f._create_body()
+            body["id"] = f.id
+            log.debug("About to create folder %s" % body)
+            request = self.gdcp.drive.auth.service.files().insert(body=body)
+            requests.append(((f, body), request))
+        for (f, body), response, e in self.gdcp.execute_batch(requests):
+            if isinstance(e, apiclient.errors.HttpError) and e.resp.status == 409:
+                log.info("Folder %s already exists with id %s" % (f.path, f.id))
+                response, e = body, None
+            if e:
+                log.warning("Creating folder %s failed, %s" % (f.path, describe_error(e)))
+                self._fail(f)
             else:
-                file_type = "file"
-            line.append(file_type)
-            if not (self._is_folder() or self._is_google_apps_doc()):
-                line.append(self.metadata["fileSize"])
-                line.append(self.metadata["md5Checksum"])
-            print "\t".join(line)
+                f._created_google_folder(response)
+                self.gdcp.count_file()
+                self.ready[f.id].set()
+
+    def _fail(self, f):
+        self.failed.add(f.id)
+        f._fail_upload()
+        self.ready[f.id].set()
+
+
+class DriveIndex(object):
+    """
+    In-memory index of Drive files built from one flat listing.
+
+    Files are kept as FileRecords and folder contents are looked up by
+    parent id.
+    Recursive listings, size totals and download plans for any folder need no
+    further API calls.
+    """
+    def __init__(self):
+        self.records = {}  # id -> FileRecord
+        self.children = {}  # parent id -> list of child ids
+        self.aliases = {}  # alias like "root" -> id
 
-    def transfer_ownership(self, email, root=True):
+    @classmethod
+    def build(cls, gdcp):
         """
-        Transfer file ownership to new_owner_email.
+        Return an index of all non-trashed files visible to gdcp.drive
+        """
+        index = cls()
+        # The root folder isn't in the listing but is needed to resolve "root"
+        request = gdcp.drive.auth.service.files().get(fileId="root",
+            fields=FILE_FIELDS)
+        index.add(execute_request(request), alias="root")
+        for i in gdcp.iter_all_files():
+            index.add(i)
+        return index
+
+    def add(self, metadata, alias=None):
+        if alias:
+            self.aliases[alias] = metadata["id"]
+        if metadata["id"] in self.records:
+            return
+        r = FileRecord.from_metadata(metadata)
+        self.records[r.id] = r
+        for p in r.parents:
+            self.children.setdefault(p, []).append(r.id)
 
-        The account for new_owner_email must be in the same Google Apps domain.
+    def get(self, gid):
         """
-        self._ensure_google_file_metadata()
+        Return FileRecord for gid, which may be an alias, or None
+        """
+        return self.records.get(self.aliases.get(gid, gid))
 
-        body = {
-            "type": "user",
-            "value": email
+    def list_children(self, gid):
+        """
+        Return FileRecords for the children of folder gid sorted by title
+        """
+        gid = self.aliases.get(gid, gid)
+        children = [self.records[c] for c in self.children.get(gid, [])]
+        return sorted(children, key=lambda r: r.title)
+
+    def walk(self, gid, path=""):
+        """
+        Generate (path, FileRecord) for everything below folder gid in
+        depth-first order, with paths relative to gid. Files in more than one
+        folder are generated once.
+        """
+        seen = set()
+        stack = [(path, r) for r in reversed(self.list_children(gid))]
+        while stack:
+            path, r = stack.pop()
+            if r.id in seen:
+                continue
+            seen.add(r.id)
+            path = os.path.join(path, r.title)
+            yield path, r
+            if r.is_folder():
+                stack.extend((path, c) for c in reversed(self.list_children(r.id)))
+
+    def size(self, gid):
+        """
+        Return (number of files, total bytes) for files below gid, or for gid
+        itself if it's a file. Google Docs have no size and aren't counted.
+        """
+        r = self.get(gid)
+        if not r.is_folder():
+            return (0, 0) if r.fileSize is None else (1, r.fileSize)
+        count, nbytes = 0, 0
+        for path, c in self.walk(r.id):
+            if c.fileSize is not None:
+                count += 1
+                nbytes += c.fileSize
+        return count, nbytes
+
+
+class DownloadState(object):
+    """
+    Byte ranges already written for a partial download.
+
+    The state is saved in a sidecar file next to the download along with the
+    Drive id, MD5 checksum and size of the file, so a later download of the
+    same Drive file to the same path only fetches the missing ranges.
+    """
+    suffix = ".gdcp-partial"
+
+    def __init__(self, path, gid, md5Checksum, fileSize, ranges=None):
+        self.path = path
+        self.id = gid
+        self.md5Checksum = md5Checksum
+        self.fileSize = fileSize
+        self.ranges = merge_ranges(ranges or [])
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path):
+        """
+        Return DownloadState saved for path or None if there isn't one.
+        """
+        try:
+            with open(path + cls.suffix) as fh:
+                state = json.load(fh)
+            return cls(path, state["id"], state["md5Checksum"],
+                state["fileSize"], state["ranges"])
+        except (OSError, IOError, ValueError, KeyError, TypeError):
+            return None
+
+    @classmethod
+    def find(cls, r, path):
+        """
+        Return DownloadState saved for FileRecord r at path or at one of the
+        names de_duplicate_path_name would have picked instead, or None.
+        """
+        candidate = path
+        i = 0
+        while os.path.exists(candidate):
+            state = cls.load(candidate)
+            if state and state.matches(r):
+                return state
+            i += 1
+            candidate = "%s_duplicate_%i" % (os.path.normpath(path), i)
+        return None
+
+    def matches(self, r):
+        """
+        Is this saved state for the same version of FileRecord r?
+        """
+        return (self.id == r.id and
+                self.md5Checksum == r.md5Checksum and
+                self.fileSize == r.fileSize and
+                os.path.isfile(self.path))
+
+    def bytes_done(self):
+        return sum([end - start + 1 for start, end in self.ranges])
+
+    def missing(self, chunksize):
+        """
+        Return list of (start, end) byte ranges not yet written, in pieces of
+        at most chunksize bytes.
+        """
+        missing = []
+        start = 0
+        for done_start, done_end in self.ranges + [(self.fileSize, self.fileSize)]:
+            if done_start > start:
+                missing.extend([(start + s, start + e) for s, e in
+                                byte_ranges(done_start - start, chunksize)])
+            start = max(start, done_end + 1)
+        return missing
+
+    def record(self, start, end):
+        """
+        Record that bytes start to end have been written. State is saved
+        until the file is complete.
+        """
+        with self.lock:
+            self.ranges = merge_ranges(self.ranges + [(start, end)])
+            if self.bytes_done() < self.fileSize:
+                self.save()
+
+    def save(self):
+        state = {
+            "id": self.id,
+            "md5Checksum": self.md5Checksum,
+            "fileSize": self.fileSize,
+            "ranges": self.ranges
         }
-        if root:
-            # Inserting an ownership permission for the top-level folder
-            # will send an email and place the folder/file in the new owner's
-            # My Drive root folder, unless they already have write permission.
-            body["role"] = "owner"
-            request = self.drive.auth.service.permissions().insert(
-                fileId=self.id,
-                body=body)
-            insert_resp = execute_request(request)
+        # Write then rename so a crash never leaves a truncated state file
+        tmp = self.path + self.suffix + ".tmp"
+        with open(tmp, "w") as fh:
+            json.dump(state, fh)
+        os.rename(tmp, self.path + self.suffix)
+
+    def remove(self):
+        try:
+            os.remove(self.path + self.suffix)
+        except OSError:
+            pass
+
+
+class UploadSession(object):
+    """
+    Journal entry for the resumable upload session of one local file.
+
+    The session URI and the last offset the server confirmed are saved under
+    the config directory so that an upload interrupted by errors or by the
+    process being killed can continue in the same session on the next run.
+    Entries are keyed by the file's path, size and mtime and by the upload
+    destination, so a changed file or a different destination starts fresh.
+    """
+    def __init__(self, f, location=None):
+        if not location:
+            location = os.path.join(os.environ["HOME"], "." + PROJ, "uploads")
+        self.location = location
+        st = os.stat(f.path)
+        key = "\t".join([os.path.abspath(f.path), str(st.st_size),
+                         repr(st.st_mtime), str(f.parent), f.title])
+        self.journal = os.path.join(location,
+            hashlib.md5(key).hexdigest() + ".json")
+        self.path = f.path
+        self.uri = None
+        self.offset = 0
+
+    def load(self):
+        """
+        Load saved session. Return True if there was one.
+        """
+        try:
+            with open(self.journal) as fh:
+                entry = json.load(fh)
+            self.uri = entry["uri"]
+            self.offset = entry["offset"]
+        except (OSError, IOError, ValueError, KeyError, TypeError):
+            return False
+        return True
+
+    def save(self, uri, offset):
+        self.uri = uri
+        self.offset = offset
+        entry = {"uri": uri, "offset": offset, "path": self.path}
+        if not os.path.isdir(self.location):
+            try:
+                os.makedirs(self.location)
+            except OSError:
+                pass  # another thread got there first
+        # Write then rename so a crash never leaves a truncated journal entry
+        tmp = self.journal + ".tmp"
+        with open(tmp, "w") as fh:
+            json.dump(entry, fh)
+        os.rename(tmp, self.journal)
+
+    def remove(self):
+        try:
+            os.remove(self.journal)
+        except OSError:
+            pass
+
+
+class MmapMediaUpload(apiclient.http.MediaUpload):
+    """
+    Media upload source that serves chunks from an mmap of a local file.
+
+    getbytes() returns buffer objects that point into the mapped pages, so
+    chunks are not copied into new strings before they are sent. Bytes are
+    fed to an MD5 the first time they are handed out, in file order, so once
+    the last chunk is sent md5() is the checksum of the whole file without
+    reading it a second time.
+
+    If chunks, a ChunkTransfer, is given chunksize() follows its current
+    chunk size instead of chunksize.
+
+    When not resumable googleapiclient puts the whole file in a multipart
+    message, which needs a str, so getbytes() returns a copy instead.
+    """
+    def __init__(self, filename, mimetype=None, chunksize=CHUNKSIZE,
+        resumable=False, chunks=None):
+        self._filename = filename
+        self._mimetype = mimetype
+        self._chunksize = chunksize
+        self._chunks = chunks
+        self._resumable = resumable
+        self._fh = open(filename, "rb")
+        self._size = os.fstat(self._fh.fileno()).st_size
+        self._map = mmap.mmap(self._fh.fileno(), 0, access=mmap.ACCESS_READ)
+        self._md5 = hashlib.md5()
+        self._md5_offset = 0  # bytes before this offset have been hashed
+
+    def chunksize(self):
+        if self._chunks:
+            return self._chunks.chunksize()
+        return self._chunksize
+
+    def mimetype(self):
+        return self._mimetype
+
+    def size(self):
+        return self._size
+
+    def resumable(self):
+        return self._resumable
+
+    def has_stream(self):
+        return False
+
+    def getbytes(self, begin, length):
+        end = min(begin + length, self._size)
+        if end > self._md5_offset:
+            # Hash from the last hashed byte rather than from begin. Resent
+            # chunks are not hashed twice, and if an upload is resumed at a
+            # later offset the skipped bytes are still included.
+            self._md5.update(buffer(self._map, self._md5_offset,
+                                    end - self._md5_offset))
+            self._md5_offset = end
+        if not self._resumable:
+            return self._map[begin:end]
+        return buffer(self._map, begin, end - begin)
+
+    def md5(self):
+        """
+        Return hex MD5 digest of the file, or None if not all bytes have been
+        sent yet.
+        """
+        if self._md5_offset < self._size:
+            return None
+        return self._md5.hexdigest()
+
+    def close(self):
+        self._map.close()
+        self._fh.close()
+
+
+class ChunkSizer(object):
+    """
+    Chunk sizes for uploads and downloads, adapted to measured throughput
+    within a global memory budget.
+
+    Each transfer gets a ChunkTransfer that starts at initial bytes. After
+    each chunk its size moves toward what the measured rate moves in target
+    seconds, at most doubling or halving at a time, and it's halved after a
+    retry. Sizes are multiples of CHUNK_ALIGN between CHUNK_ALIGN and
+    maximum. Chunks in flight across all transfers add up to at most budget
+    bytes, so a transfer takes a smaller chunk or waits when the budget is
+    used up. If fixed is set every chunk is that size and only the budget
+    applies.
+    """
+    def __init__(self, fixed=None, budget=CHUNK_BUDGET, initial=CHUNKSIZE,
+        maximum=CHUNK_MAX, target=CHUNK_SECONDS):
+        self.budget = max(self.align(budget), CHUNK_ALIGN)
+        self.maximum = min(self.align(maximum), self.budget)
+        if fixed:
+            fixed = min(self.align(fixed), self.budget)
+        self.fixed = fixed
+        self.initial = fixed or min(self.align(initial), self.maximum)
+        self.target = target
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    @staticmethod
+    def align(size):
+        return max(int(size) // CHUNK_ALIGN, 1) * CHUNK_ALIGN
+
+    def chunksize(self):
+        """
+        Return the size a transfer starts with
+        """
+        return self.initial
+
+    def transfer(self):
+        return ChunkTransfer(self)
+
+    def reserve(self, size, partial=True):
+        """
+        Wait for room in the budget and reserve it for a chunk of up to size
+        bytes. Return the number of bytes reserved, which is less than size
+        if partial and less room is left.
+        """
+        with self.condition:
+            while self.in_flight:
+                room = self.budget - self.in_flight
+                if room >= size or (partial and room >= CHUNK_ALIGN):
+                    break
+                self.condition.wait()
+            if partial:
+                size = min(size, self.align(self.budget - self.in_flight))
+            self.in_flight += size
+            return size
+
+    def release(self, size):
+        with self.condition:
+            self.in_flight -= size
+            self.condition.notify_all()
+
+    def next_size(self, size, nbytes=0, seconds=0, retried=False):
+        """
+        Return the chunk size to follow a chunk of size bytes that moved
+        nbytes in seconds, or that had to be retried
+        """
+        if self.fixed:
+            return self.fixed
+        if retried:
+            size = size // 2
+        elif seconds > 0 and nbytes > 0:
+            wanted = nbytes / seconds * self.target
+            size = min(max(wanted, size // 2), size * 2)
+        return min(self.align(size), self.maximum)
+
+
+class ChunkTransfer(object):
+    """
+    Chunk size of one transfer, see ChunkSizer
+    """
+    def __init__(self, sizer):
+        self.sizer = sizer
+        self.size = sizer.initial
+        self.reserved = 0  # budget held for the chunk in flight
+
+    def chunksize(self):
+        """
+        Return the size of the chunk in flight, or of the next one
+        """
+        return self.reserved or self.size
+
+    def reserve(self):
+        """
+        Reserve budget for the next chunk and return its size
+        """
+        self.release()
+        self.reserved = self.sizer.reserve(self.size)
+        return self.reserved
+
+    def release(self):
+        if self.reserved:
+            self.sizer.release(self.reserved)
+            self.reserved = 0
+
+    def done(self, nbytes, t1, t2):
+        """
+        Adapt chunk size to a chunk of nbytes sent or received between
+        datetimes t1 and t2
+        """
+        self.size = self.sizer.next_size(self.size, nbytes,
+            (t2 - t1).total_seconds())
+        self.release()
+
+    def retried(self):
+        self.size = self.sizer.next_size(self.size, retried=True)
+        self.release()
+
+    def ranges(self, gaps):
+        """
+        Generate (start, end) byte ranges covering each (start, end) in gaps,
+        one chunk at a time. Each range is generated with budget reserved
+        for it.
+        """
+        try:
+            for start, end in gaps:
+                while start <= end:
+                    size = self.reserve()
+                    yield start, min(start + size - 1, end)
+                    start += size
+        finally:
+            self.release()
+
+
+class RateLimiter(object):
+    """
+    Token bucket every Drive API call passes through, shared by all threads.
+
+    Calls run at qps per second on average, and up to burst at once after a
+    quiet period. A rate limit error from Drive halves the rate, at most once
+    a second, and each following second without one adds back a tenth of qps
+    until the rate is qps again. qps 0 disables limiting.
+    """
+    def __init__(self, qps=QPS, burst=BURST):
+        self.lock = threading.Lock()
+        self.configure(qps, burst)
+
+    def configure(self, qps, burst):
+        with self.lock:
+            self.qps = float(qps)
+            self.rate = self.qps
+            self.burst = max(float(burst), 1.0)
+            self.tokens = self.burst
+            self.updated = time.time()
+            self.changed = 0  # time of the last rate change
+            self.throttles = 0
+
+    def _refill(self, now):
+        if self.rate < self.qps and now - self.changed >= 1:
+            steps = int(now - self.changed)
+            self.rate = min(self.rate + steps * self.qps / 10, self.qps)
+            self.changed += steps
+        self.tokens = min(self.tokens + (now - self.updated) * self.rate, self.burst)
+        self.updated = now
+
+    def acquire(self, calls=1):
+        """
+        Wait until calls API calls may be made
+        """
+        if not self.qps:
+            return
+        with self.lock:
+            self._refill(time.time())
+            # Take the tokens now, going into debt if there aren't enough, so
+            # threads waiting at the same time queue up behind each other
+            self.tokens -= calls
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+    def throttle(self):
+        """
+        Slow down after Drive reported a rate limit error
+        """
+        if not self.qps:
+            return
+        with self.lock:
+            now = time.time()
+            self._refill(now)
+            self.throttles += 1
+            if now - self.changed >= 1:
+                self.rate = max(self.rate / 2, self.qps / 100)
+                self.changed = now
+                log.warning("Rate limited, slowing to %.02f calls/s" % self.rate)
+
+
+# Shared by every API call in the process, configured by --qps and --burst
+rate_limiter = RateLimiter()
+
+# httplib2.Http object checked out of an HttpPool by each thread, see
+# HttpPool.use. Threads without one share the object of
+# drive.auth.service, which is only safe for one thread at a time.
+thread_http = threading.local()
+
+
+class DownloadStream(object):
+    """
+    Downloads byte ranges straight into files over a reusable httplib
+    connection.
+
+    httplib2 returns a response body as one string, so a download held a
+    whole chunk in memory. Here the body is written to the file as it's
+    read, at most bufsize bytes at a time, and memory use doesn't grow with
+    the chunk size. Python 2's httplib has no readinto(), so each read makes
+    a new string of up to bufsize bytes rather than filling one buffer, but
+    only one is alive at a time.
+
+    A DownloadStream is not thread-safe, see Gdcp.download_stream. Streams
+    of all threads share credentials, and refresh_lock makes sure only one
+    of them refreshes an expired token.
+    """
+    redirect_codes = (301, 302, 303, 307)
+    max_redirects = 5
+    refresh_lock = threading.Lock()
+
+    def __init__(self, credentials, bufsize=STREAM_BUFSIZE, timeout=60):
+        self.credentials = credentials
+        self.bufsize = bufsize
+        self.timeout = timeout
+        self.conn = None
+        self.address = None  # (scheme, netloc) of self.conn
+
+    def fetch(self, url, bytes_start, bytes_end, fh, md5=None):
+        """
+        GET bytes_start to bytes_end of url and write them to fh at
+        bytes_start. Return [response, md5] where md5 is a copy of md5
+        updated with the range, or None if md5 is None or the range wasn't
+        written. response.range_ok is True if the range was written, from a
+        206 response or a 200 response with the whole file when bytes_start
+        is 0.
+        """
+        refreshed = False
+        redirects = 0
+        while True:
+            headers = {"range": "bytes=%i-%i" % (bytes_start, bytes_end)}
+            self.credentials.apply(headers)
+            response = self._request(url, headers)
+            response.range_ok = False
+            if response.status == 401 and not refreshed:
+                response.read()
+                self._refresh(headers)
+                refreshed = True
+            elif response.status in self.redirect_codes and redirects < self.max_redirects:
+                response.read()
+                url = urlparse.urljoin(url, response.getheader("location"))
+                redirects += 1
+            elif response.status == 206 or (response.status == 200 and bytes_start == 0):
+                md5 = self._write(response, bytes_start, bytes_end, fh, md5)
+                response.range_ok = True
+                return [response, md5]
+            elif response.status == 200:
+                # The server ignored the range and is sending the whole file,
+                # which doesn't belong at bytes_start. Don't read it.
+                log.warning("Got status 200 for range starting at %i" % bytes_start)
+                self.close()
+                return [response, None]
+            else:
+                response.read()
+                return [response, None]
+
+    def _refresh(self, headers):
+        """
+        Refresh the access token that was sent in headers, unless another
+        thread has refreshed it since
+        """
+        with self.refresh_lock:
+            current = {}
+            self.credentials.apply(current)
+            # oauth2client sets "Authorization", compare case-insensitively
+            if (header_value(current, "authorization") ==
+                    header_value(headers, "authorization")):
+                self.credentials.refresh(httplib2.Http())
+
+    def _request(self, url, headers):
+        scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+        if query:
+            path += "?" + query
+        reused = self.conn is not None and self.address == (scheme, netloc)
+        if not reused:
+            self.close()
+            if scheme == "https":
+                self.conn = httplib.HTTPSConnection(netloc, timeout=self.timeout)
+            else:
+                self.conn = httplib.HTTPConnection(netloc, timeout=self.timeout)
+            self.address = (scheme, netloc)
+        try:
+            self.conn.request("GET", path, headers=headers)
+            return self.conn.getresponse()
+        except (httplib.HTTPException, socket.error):
+            self.close()
+            if reused:
+                # The server may have dropped the idle connection, try once
+                # more on a new one
+                return self._request(url, headers)
+            raise
+
+    def _write(self, response, bytes_start, bytes_end, fh, md5=None):
+        if md5:
+            md5 = md5.copy()
+        remaining = bytes_end - bytes_start + 1
+        fh.seek(bytes_start)
+        try:
+            while remaining > 0:
+                piece = response.read(min(self.bufsize, remaining))
+                if not piece:
+                    raise httplib.IncompleteRead("", remaining)
+                fh.write(piece)
+                if md5:
+                    md5.update(piece)
+                remaining -= len(piece)
+            if not response.isclosed():
+                # More body than the range asked for, don't read it just to
+                # reuse the connection
+                self.close()
+        except:
+            self.close()
+            raise
+        fh.flush()
+        return md5
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+            self.address = None
+
+
+class FileProgress(object):
+    """
+    Progress output for one file transfer.
+
+    When unbuffered, writes go straight to STDOUT and the current line is
+    rewritten as chunks arrive. When several files transfer at once their
+    carriage returns would garble each other, so in buffered mode only the
+    final state of each line is kept and everything is printed in one piece
+    by flush() when the transfer finishes. When quiet nothing is printed.
+    """
+    def __init__(self, buffered=False, quiet=False):
+        self.buffered = buffered
+        self.quiet = quiet
+        self.lines = []
+        self.line = ""
+
+    def write(self, msg=""):
+        if self.quiet:
+            return
+        if self.buffered:
+            self.line += msg
         else:
-            # First make sure writer permission is inserted. Suppress emails.
-            # If we just insert an ownership permission here first, and there
-            # wasn't already a write permission, the new owner will:
-            # 1) receive an email for every file
-            # 2) the file will be placed in their My Drive root folder. Neither is
-            # desirable.
-            body["role"] = "writer"
-            request = self.drive.auth.service.permissions().insert(
-                fileId=self.id,
-                body=body,
-                sendNotificationEmails=False)
-            insert_resp = execute_request(request)
-            log.debug("Granted write privileges for %s" % self.title)
-            # Now update permission to owner role. Because the new owner
-            # already had write permission an email is not sent and a
-            # reference to the file is not placed in My Drive.
-            permId = insert_resp["id"]
-            body["role"] = "owner"
-            request = self.drive.auth.service.permissions().update(
-                fileId=self.id,
-                permissionId=permId,
-                body=body,
-                transferOwnership=True)
-            execute_request(request)
-        self.gdcp.file_count += 1
-        stdoutn("%s\t%s" % (self.title, self.id))
-        log.info("Transferred ownership of %s" % self.title)
+            stdout(msg)
 
-        if self._is_folder():
-            children = self._get_children()
-            for f in children:
-                f.transfer_ownership(email, root=False)
+    def rewrite(self, msg=""):
+        if self.quiet:
+            return
+        if self.buffered:
+            self.line = msg
+        else:
+            stdoutr(msg)
 
-        # Do full gc because Python2.7's automatic gc still accumulates more
-        # allocated memory than I'd like. Most of the performance hit in this
-        # program is network latency so the wall time shouldn't budge
-        gc.collect()
+    def newline(self, msg=""):
+        if self.quiet:
+            return
+        if self.buffered:
+            self.lines.append(self.line + msg)
+            self.line = ""
+        else:
+            stdoutn(msg)
+
+    def flush(self):
+        if self.buffered and (self.lines or self.line):
+            stdout("".join([l + "\n" for l in self.lines]) + self.line)
+            self.lines = []
+            self.line = ""
+
+
+Lane = collections.namedtuple("Lane", "name files workers seconds")
+
+
+class PendingDownload(collections.namedtuple("PendingDownload", "record path")):
+    """
+    File of a multi-file download waiting for a TransferScheduler worker,
+    its FileRecord and the local path reserved for it
+    """
+    __slots__ = ()
 
     @property
-    def metadata(self):
-        return self._metadata
+    def fileSize(self):
+        return self.record.fileSize
 
-    @metadata.setter
-    def metadata(self, response):
-        """
-        Add response for file metadata from Google Drive
 
-        For response keys/values see return object of get()
-        https://developers.google.com/resources/api-libraries/documentation/drive/v2/python/latest/drive_v2.files.html#get
+class TransferScheduler(object):
+    """
+    Order of multi-file transfers, sorted and packed by fileSize.
+
+    Files of at least large bytes go in a large lane, where downloads use
+    gdcp.segments byte ranges at once. Smaller files go in a small lane
+    where most of the time goes to per-file request latency, and they don't
+    wait behind large files. gdcp.jobs workers are split between the lanes
+    so that both should finish about the same time, and each lane starts
+    with its largest files (longest processing time first) so no large file
+    is left to finish alone at the end.
+
+    A file is predicted to take latency seconds plus its size at rate bytes
+    per second per worker, or per byte range in flight.
+    """
+    def __init__(self, gdcp, large=LARGE_FILE, rate=WORKER_RATE,
+        latency=FILE_SECONDS):
+        self.gdcp = gdcp
+        self.large = large
+        self.rate = float(rate)
+        self.latency = latency
+
+    def seconds(self, f, segments=1):
+        return self.latency + f.fileSize / (self.rate * segments)
+
+    def plan(self, files):
         """
-        if response:
-            self._metadata = response
-            self.id = response["id"]
-            self.title = response["title"]
-            self.google_md5Checksum = response.get("md5Checksum", None)
-            self.downloadUrl = response.get("downloadUrl", None)
-            self.fileSize = int(response.get("fileSize", 0))
-            self.mimetype = response["mimeType"]
-            if self._is_google_apps_doc():
-                self.doctype = self._get_google_apps_doctype()
+        Return list of non-empty Lanes for files, each with its files sorted
+        largest first, its number of workers and its predicted seconds.
+        Files are anything with a fileSize, GdcpFiles of an upload or
+        PendingDownloads.
+        """
+        files = sorted(files, key=lambda f: f.fileSize, reverse=True)
+        large = [f for f in files if f.fileSize >= self.large]
+        small = [f for f in files if f.fileSize < self.large]
+        large_seconds = [self.seconds(f, self.gdcp.segments) for f in large]
+        small_seconds = [self.seconds(f) for f in small]
+        jobs = self.gdcp.jobs
+        if not large or not small or jobs < 2:
+            split = [jobs if large else 0]
+        else:
+            split = range(1, jobs)
+        # Pick the split with the lowest bound on the finish time, the larger
+        # of the longest file and the lane's total work spread over its
+        # workers, then pack that split for the prediction
+        def bound(seconds, workers):
+            if not seconds:
+                return 0
+            return max(seconds[0], sum(seconds) / workers)
+        n = min(split, key=lambda n: max(bound(large_seconds, n),
+            bound(small_seconds, jobs - n)))
+        lanes = []
+        if large:
+            lanes.append(Lane("large", large, n, lpt_seconds(large_seconds, n)))
+        if small:
+            lanes.append(Lane("small", small, jobs - n,
+                lpt_seconds(small_seconds, jobs - n)))
+        return lanes
+
+    def run(self, files, task):
+        """
+        Transfer files with a WorkerPool per lane. task(f, segments)
+        returns the WorkerPool task that transfers f, with segments byte
+        ranges at once for a download.
+        """
+        if not files:
+            return
+        lanes = self.plan(files)
+        t0 = datetime.datetime.now()
+        seconds = max(lane.seconds for lane in lanes)
+        finish = t0 + datetime.timedelta(seconds=seconds)
+        msg = ["%i files, %i bytes:" % (len(files), sum(f.fileSize for f in files))]
+        for lane in lanes:
+            msg.append("%i %s on %i workers," % (len(lane.files), lane.name, lane.workers))
+        msg.append("predicted to finish at %s (%s)" %
+            (finish.strftime("%H:%M:%S"), format_timedelta(t0, finish)))
+        log.info(" ".join(msg))
+        self.gdcp.report(" ".join(msg))
+        pools = []
+        feeders = []
+        for lane in lanes:
+            segments = self.gdcp.segments if lane.name == "large" else 1
+            pool = self.gdcp.worker_pool(lane.workers)
+            pools.append(pool)
+            # submit() blocks while a lane's queue is full, so each lane gets
+            # its own thread to feed it
+            t = threading.Thread(target=self._feed,
+                args=(pool, lane.files, task, segments))
+            t.daemon = True
+            t.start()
+            feeders.append(t)
+        for t in feeders:
+            t.join()
+        for pool in pools:
+            pool.join()
+        log.info("Transferred %i files in %s, predicted %s" % (len(files),
+            format_timedelta(t0, datetime.datetime.now()),
+            format_timedelta(t0, finish)))
+
+    def _feed(self, pool, files, task, segments):
+        for f in files:
+            pool.submit(task(f, segments))
+
+
+class WorkerPool(object):
+    """
+    Fixed-size pool of worker threads fed from a bounded queue.
+
+    Tasks are callables that take one argument, the per-worker context
+    returned by init() (e.g. an authorized httplib2.Http object), or None if
+    init is not given. finish(context) is called when a worker stops.
+    submit() blocks while the queue is full, so at most queue_size tasks,
+    2 * size by default, wait however many are submitted. A queue_size of 0
+    never blocks. Multi-file transfers walk the whole tree
+    before submitting, keeping only the small PendingDownloads (or upload
+    GdcpFiles) that TransferScheduler sorts, and feed each pool from its
+    own thread.
+    """
+    def __init__(self, size, init=None, finish=None, queue_size=None):
+        self.size = size
+        self.init = init
+        self.finish = finish
+        if queue_size is None:
+            queue_size = size * 2
+        self.queue = Queue.Queue(maxsize=queue_size)
+        self.threads = []
+        for i in range(size):
+            t = threading.Thread(target=self._work)
+            t.daemon = True  # don't block exit on SIGINT
+            t.start()
+            self.threads.append(t)
+
+    def submit(self, task):
+        self.queue.put(task)
+
+    def wait(self):
+        """
+        Wait for all submitted tasks to finish. Workers keep running.
+        """
+        self.queue.join()
 
-    def _get_children(self):
+    def join(self):
         """
-        Return list of GdcpFile objects for this file's children
+        Wait for all submitted tasks to finish and stop the workers.
         """
-        children = []
-        query = "trashed = false and '%s' in parents" % self.id
-        request = self.drive.auth.service.files().list(q=query, maxResults=460)
-        while request != None:
-            response = execute_request(request)
-            for i in response["items"]:
-                g = GdcpFile(self.gdcp) # child inherits Gdcp object
-                g.metadata = i
-                g.check_checksum = self.check_checksum # child inherits check_checksum
-                g.root = self.root # child inherits root
-                children.append(g)
-            request = self.drive.auth.service.files().list_next(request, response)
+        for t in self.threads:
+            self.queue.put(None)
+        for t in self.threads:
+            t.join()
+
+    def _work(self):
+        ctx = None
+        if self.init:
+            ctx = self.init()
+        while True:
+            task = self.queue.get()
+            if task is None:
+                if self.finish:
+                    self.finish(ctx)
+                self.queue.task_done()
+                return
+            try:
+                task(ctx)
+            except Exception as e:
+                log.exception("Worker task raised %s" % e)
+            finally:
+                self.queue.task_done()
+
 
-        # Sort by title
-        children_sorted = sorted(children, key=lambda g: g.title)
+class HttpPool(object):
+    """
+    Authorized httplib2.Http objects that threads check out and back in.
 
-        return children_sorted
+    Every object is authorized with the same credentials, so a token refresh
+    by one is used by all. httplib2.Http keeps its connections open between
+    requests, so a thread that checks out an idle object skips the TCP and
+    TLS handshakes. New objects are made with factory() when none are idle.
 
-    def _ensure_google_file_metadata(self):
+    use() also makes the object the calling thread's default, which
+    execute_request and GdcpFile._get_http send requests with when they
+    aren't given one.
+    """
+    def __init__(self, factory):
+        self.factory = factory
+        self.lock = threading.Lock()
+        self.idle = []
+        self.created = 0
+        self.reused = 0
+        self.in_use = 0
+        self.peak = 0
+
+    def checkout(self):
+        with self.lock:
+            self.in_use += 1
+            self.peak = max(self.peak, self.in_use)
+            if self.idle:
+                self.reused += 1
+                return self.idle.pop()
+            self.created += 1
+        return self.factory()
+
+    def checkin(self, http):
+        with self.lock:
+            self.in_use -= 1
+            self.idle.append(http)
+
+    def use(self):
         """
-        Ensure that file metadata from Google is present. Don't perform remote
-        API call if file metadata is already present.
+        Check out an object for the calling thread's requests and return it
+        for release()
         """
-        if not self.metadata and self.id:
-            log.debug("Ensure fired for %s, %s" % (self.id, self.title))
-            request = self.drive.auth.service.files().get(fileId=self.id)
-            response = execute_request(request)
-            self.metadata = response
+        http = self.checkout()
+        thread_http.http = http
+        return http
 
-    def _create_google_folder(self):
+    def release(self, http):
+        thread_http.http = None
+        self.checkin(http)
+
+    def call(self, fn, *args, **kwargs):
         """
-        Create a folder in Google Drive
+        Return fn(*args, **kwargs) called with an object checked out for the
+        calling thread's requests
         """
-        body = self._create_body()
-        log.debug("About to create folder %s" % body)
-        request = self.drive.auth.service.files().insert(body=body)
-        response = execute_request(request)
-        # Sometimes folders take a while to become available. Try to get metadata
-        # from Google to make sure it's available before moving on
-        # Skipping here for now, hopefully retries in API calls that use this
-        # folder as a parent will be sufficient to hide errors
-        #request = self.drive.auth.service.files().get(fileId=response["id"])
-        #response = execute_request(request)
-        self.metadata = response
-        path = self.path if self.path else self.title
-        if not path.endswith("/"):
-            path += "/"
-        stdoutn("%s" % path)
-        log.info("Created folder %s %s" % (self.title, self.id))
+        http = self.use()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            self.release(http)
 
-    def _create_local_folder(self, path=None):
+    def stats(self):
         """
-        Create a local folder
+        Return dict of the number of objects created, checkouts that reused
+        an idle object, objects idle and checked out now, and the most
+        checked out at once
         """
-        if path:
-            folder_path = path
-        else:
-            folder_path = self.path
-
-        try:
-            os.makedirs(folder_path)
-        except OSError:
-            error("Could not create directory %s. Perhaps it already exists."
-                  % folder_path)
-        if path:
-            log.info("Created folder %s" % folder_path)
-        else:
-            log.info("Created folder %s %s" % (folder_path, self.id))
-        if not folder_path.endswith("/"):
-            folder_path += "/"
-        stdoutn("%s" % folder_path)
+        with self.lock:
+            return {"created": self.created, "reused": self.reused,
+                "idle": len(self.idle), "in_use": self.in_use, "peak": self.peak}
 
-    def _is_folder(self):
-        self._ensure_google_file_metadata()
-        return self.mimetype == "application/vnd.google-apps.folder"
+    def summary(self):
+        return ("HTTP pool: %(created)i created, %(reused)i reused, "
+            "%(idle)i idle, %(in_use)i in use, %(peak)i at most" % self.stats())
 
-    def _is_file(self): #CJK added
-        self._ensure_google_file_metadata()
-        return self.mimetype == "application/vnd.google-apps.file"
 
-    def _is_google_apps_doc(self):
-        self._ensure_google_file_metadata()
-        if self.mimetype.startswith("application/vnd.google-apps."):
-            # Folders are special google apps docs which we consider separately
-            if not self._is_folder():
-                return True
-        return False
+class Future(object):
+    """
+    Result of a GdcpClient operation running in another thread
+    """
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._result = None
+        self._exception = None
+        self._callbacks = []
 
-    def _get_google_apps_doctype(self):
-        if self._is_google_apps_doc():
-            return self.mimetype.split("application/vnd.google-apps.")[-1]
+    def done(self):
+        return self._event.is_set()
 
-    def _create_media_body(self):
-        return apiclient.http.MediaFileUpload(self.path,
-            chunksize=CHUNKSIZE, resumable=True, mimetype=self.mimetype)
+    def result(self, timeout=None):
+        """
+        Wait up to timeout seconds, or forever if None, for the operation and
+        return its result. Raise the operation's exception if it failed.
+        """
+        e = self.exception(timeout)
+        if e is not None:
+            raise e
+        return self._result
 
-    def _create_body(self):
-        body = {"title": self.title}
-        if self.mimetype is None:
-            body["mimeType"] = "application/vnd.google-apps.folder"
-        else:
-            body["mimeType"] = self.mimetype
-        if self.parent is not None:
-            body["parents"] = [{"id": self.parent}]
-        return body
+    def exception(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise RuntimeError("Timed out waiting for result")
+        return self._exception
 
-    def _check_md5(self):
+    def add_done_callback(self, fn):
         """
-        Confirm that response MD5 from Google matches MD5 for local
-        file
+        Call fn(future) once the operation is done, right away if it already
+        is
         """
-        stdout(" MD5...")
-        log.info("Calculating MD5 checksum for %s" % self.path)
-        try:
-            output = subprocess.check_output(["openssl", "md5", self.path],
-                                             stderr=subprocess.STDOUT)
-        except subprocess.CalledProcessError:
-            error("MD5 calculation exited with an error: '%s'" %
-                  output.rstrip())
-        self.local_md5Checksum = output.split()[-1]
-        if self.local_md5Checksum == self.google_md5Checksum:
-            stdout("OK")
-            log.info("MD5 OK.  %s (local) == %s" %
-                     (self.local_md5Checksum, self.google_md5Checksum))
-            return True
-        else:
-            stdout("FAIL")
-            log.warning("MD5 failed.  %s (local) != %s" %
-                        (self.local_md5Checksum, self.google_md5Checksum))
-            self._fail_md5()
-            return False
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _finish(self, result=None, exception=None):
+        with self._lock:
+            self._result = result
+            self._exception = exception
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception as e:
+                log.exception("Future callback raised %s" % e)
 
-    def _passes_excludes(self):
+
+class GdcpClient(object):
+    """
+    Library interface to run Drive operations from other programs.
+
+    Each operation returns a Future at once and runs with a quiet Gdcp
+    object on one of concurrency worker threads, the rest waiting their
+    turn. A worker checks an authorized HTTP object out of the shared pool
+    for all requests of its operations. Operations share the rate limiter,
+    the chunk budget and the pool of HTTP objects. options are passed to
+    each Gdcp, e.g. jobs=4 to transfer four files of each operation at once.
+    close() waits for submitted operations and stops the workers.
+
+    Example:
+      client = GdcpClient(concurrency=2, jobs=4)
+      futures = [client.download([gid], root=path) for gid, path in todo]
+      results = [f.result() for f in futures]
+    """
+    def __init__(self, drive=None, concurrency=4, **options):
+        if drive is None:
+            drive = create_GoogleDrive()
+        self.drive = drive
+        options.setdefault("chunks", ChunkSizer())
+        options.setdefault("http_pool", HttpPool(drive.auth.Get_Http_Object))
+        options["quiet"] = True
+        self.options = options
+        http_pool = options["http_pool"]
+        self.pool = WorkerPool(max(concurrency, 1), init=http_pool.use,
+            finish=http_pool.release, queue_size=0)
+
+    def submit(self, fn, *args, **kwargs):
         """
-        Check if file title passes exclude rules
+        Run fn(gdcp, *args, **kwargs) with a new Gdcp object when a worker is
+        free and return a Future of its return value
         """
-        if self._is_folder():
-            if not self.gdcp.exclude_folders:
-                # By default folders always pass
-                return True
-            # If exlude_folders is True, then apply rules even if this is a
-            # folder
+        future = Future()
 
-        if self.gdcp.include:
-            passed = False
-        else:
-            passed = True
-        for regex in self.gdcp.excludes:
-            if regex.match(self.title):
-                passed = not passed
-                break
-        return passed
+        def run(http):
+            try:
+                gdcp = Gdcp(self.drive, **self.options)
+                result = fn(gdcp, *args, **kwargs)
+            except (Exception, SystemExit) as e:
+                # error() exits, which should only end this operation
+                future._finish(exception=e)
+            else:
+                future._finish(result=result)
 
-    def _fail_md5(self):
-        self.fail_md5_flag = True
-        self.gdcp.failures["MD5"].append(self)
+        self.pool.submit(run)
+        return future
 
-    def _fail_upload(self):
-        self.fail_upload_flag = True
-        self.gdcp.failures["HTTP"].append(self)
+    def close(self):
+        """
+        Wait for submitted operations to finish and stop the workers
+        """
+        self.pool.join()
 
-    def _fail_download(self):
-        self.fail_download_flag = True
-        self.gdcp.failures["HTTP"].append(self)
+    def download(self, ids, root=".", checksum=True):
+        """
+        Download files and folders in ids to folder root. The Future's result
+        is a dict of transfer counts and failed paths, see transfer_result().
+        """
+        def download(gdcp):
+            gdcp.download(ids, checksum, root)
+            return transfer_result(gdcp)
+        return self.submit(download)
+
+    def upload(self, paths, parent="root", checksum=True):
+        """
+        Upload local files and folders in paths to folder parent. The Future's
+        result is like download's.
+        """
+        def upload(gdcp):
+            gdcp.upload(paths, parent=parent, checksum=checksum)
+            return transfer_result(gdcp)
+        return self.submit(upload)
+
+    def list(self, gid, depth=0):
+        """
+        List file gid and, if it's a folder, its contents up to depth levels
+        down. The Future's result is a list of dicts as from Gdcp.get_list().
+        """
+        return self.submit(lambda gdcp: gdcp.get_list(gid, depth=depth))
 
 
 # -----------------------------------------------------------------------------
@@ -984,8 +3231,12 @@ def create_configdir(location=None):
 @backoff.on_exception(backoff.expo, httplib2.HttpLib2Error, max_tries=6)
 @backoff.on_exception(backoff.expo, socket.error, max_tries=6)
 @backoff.on_exception(backoff.expo, socket.timeout, max_tries=6)
-def execute_request(request):
-    return request.execute()
+def execute_request(request, http=None, calls=1):
+    """
+    Execute request after waiting for rate_limiter. calls is the number of
+    API calls in request, more than one for a batch.
+    """
+    return limited_execute(request, http, calls)
 
 # Don't forget that any exceptions handled here should also be dealt
 # with in except where this function is used in case all retries fail
@@ -996,44 +3247,279 @@ def execute_request(request):
 @backoff.on_exception(backoff.expo, httplib2.HttpLib2Error, max_tries=6)
 @backoff.on_exception(backoff.expo, socket.error, max_tries=6)
 @backoff.on_exception(backoff.expo, socket.timeout, max_tries=6)
-def execute_upload_request(request):
-    return request.execute()
+def execute_upload_request(request, http=None):
+    return limited_execute(request, http)
+
+def current_http():
+    """
+    Return the calling thread's httplib2.Http object, or None
+    """
+    return getattr(thread_http, "http", None)
+
+def limited_execute(request, http=None, calls=1):
+    if http is None:
+        http = current_http()
+    rate_limiter.acquire(calls)
+    try:
+        return request.execute(http=http)
+    except apiclient.errors.HttpError as e:
+        if is_rate_limited(e):
+            rate_limiter.throttle()
+        raise
+
+def execute_batch(service, requests, retry_limit=6):
+    """
+    Execute list of (key, request) in Drive batch requests of at most
+    BATCH_SIZE calls. Return list of (key, response, exception) in the same
+    order as requests, with exception None for calls that succeeded.
+
+    Calls that fail with a retriable error (see is_retriable) are retried in
+    later batches after an exponential delay.
+    """
+    results = [None] * len(requests)
+    todo = range(len(requests))
+    retries = 0
+    while todo:
+        retry = []
+        for i in range(0, len(todo), BATCH_SIZE):
+            chunk = todo[i:i+BATCH_SIZE]
+
+            def callback(request_id, response, exception):
+                n = int(request_id)
+                if exception and is_rate_limited(exception):
+                    rate_limiter.throttle()
+                if exception and is_retriable(exception) and retries < retry_limit:
+                    retry.append(n)
+                results[n] = (requests[n][0], response, exception)
+
+            batch = service.new_batch_http_request(callback=callback)
+            for n in chunk:
+                batch.add(requests[n][1], request_id=str(n))
+            try:
+                execute_request(batch, calls=len(chunk))
+            except (apiclient.errors.HttpError, httplib2.HttpLib2Error,
+                    socket.error, socket.timeout) as e:
+                # Whole batch failed after retries
+                for n in chunk:
+                    results[n] = (requests[n][0], None, e)
+        todo = sorted(retry)
+        if todo:
+            log.warning("Retrying %i batched calls in %is" % (len(todo), delay(retries)))
+            time.sleep(delay(retries))
+            retries += 1
+    return results
+
+def is_retriable(e):
+    """
+    Return True if exception e from an API call is worth retrying, i.e. a 5xx
+    server error or a rate limit error.
+    """
+    if not isinstance(e, apiclient.errors.HttpError):
+        return False
+    return e.resp.status in [500, 502, 503, 504] or is_rate_limited(e)
+
+def is_rate_limited(e):
+    """
+    Return True if exception e from an API call is a rate limit error
+    """
+    if not isinstance(e, apiclient.errors.HttpError):
+        return False
+    status = e.resp.status
+    if status == 429:
+        return True
+    if status == 403:
+        try:
+            reasons = [err.get("reason") for err in
+                       json.loads(e.content)["error"].get("errors", [])]
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return False
+        return bool(set(reasons) & set(["rateLimitExceeded", "userRateLimitExceeded"]))
+    return False
+
+def describe_error(e):
+    """
+    Return short description of exception e
+    """
+    if hasattr(e, "resp"):
+        return "%s %i" % (type(e).__name__, e.resp.status)
+    return "%s %s" % (type(e).__name__, e)
 
 def response_is_bad(response):
     """
-    Return True if response status is not 206 or 200.
+    Return True if the range of a DownloadStream.fetch wasn't written.
 
-    response is return value from httplib2.http.request GET call, which
-    is a two-item list of [response, content]
+    response is the [response, md5] return value of DownloadStream.fetch
     """
-    bad = not (int(response[0].status) in [206, 200])
+    bad = not response[0].range_ok
     if bad:
         log.warning("Bad status %s" % response[0].status)
     return bad
 
+def header_value(headers, name):
+    """
+    Return the value of header name from dict headers ignoring case, or None.
+    """
+    for key, value in headers.items():
+        if key.lower() == name:
+            return value
+    return None
+
 # Don't forget that any exceptions handled here should also be dealt
 # with in except where this function is used in case all retries fail
-@backoff.on_exception(backoff.expo, httplib.ResponseNotReady, max_tries=6)
-@backoff.on_exception(backoff.expo, httplib.IncompleteRead, max_tries=6)
+@backoff.on_exception(backoff.expo, httplib.HTTPException, max_tries=6)
 @backoff.on_exception(backoff.expo, socket.error, max_tries=6)
 @backoff.on_exception(backoff.expo, socket.timeout, max_tries=6)
 @backoff.on_predicate(backoff.expo, response_is_bad, max_tries=6)
-def execute_download_request(h, url, bytes_start, bytes_end):
+def execute_stream_request(stream, url, bytes_start, bytes_end, fh, md5=None):
     """
-    Perform GET with httplib2.http object
+    Download a byte range straight into a file with DownloadStream.fetch
 
     Args:
-      h = authenticated httplib2.http object
+      stream = DownloadStream
       url = URL to download from
       bytes_start = first byte in range starting at 0
       bytes_end = last byte in range
+      fh = file to write the range to at bytes_start
+      md5 = hashlib MD5 of the bytes before bytes_start, or None
+    """
+    rate_limiter.acquire()
+    # Returns [response, md5]
+    response = stream.fetch(url, bytes_start, bytes_end, fh, md5)
+    if int(response[0].status) == 429:
+        rate_limiter.throttle()
+    return response
+
+def upload_session_offset(http, uri, size):
+    """
+    Return (offset, None) where offset is how many bytes of a size byte
+    upload Drive has committed in the resumable session at uri, (size,
+    metadata) if the upload is complete, or None if the session is gone.
+    """
+    rate_limiter.acquire()
+    resp, content = http.request(uri, "PUT",
+        headers={"Content-Range": "bytes */%i" % size, "content-length": "0"})
+    if resp.status in (200, 201):
+        return (size, json.loads(content))
+    if resp.status == 308:
+        if "range" in resp:
+            return (int(resp["range"].split("-")[1]) + 1, None)
+        return (0, None)
+    if resp.status in (404, 410):
+        return None
+    raise apiclient.errors.HttpError(resp, content, uri=uri)
+
+def transfer_result(gdcp):
+    """
+    Return dict of the files and bytes transferred and skipped by gdcp, and
+    the paths of files that failed to transfer or failed MD5 verification
+    """
+    with gdcp.lock:
+        return {"files": gdcp.file_count, "bytes": gdcp.bytes_transferred,
+            "skipped": gdcp.skipped_count, "bytes_skipped": gdcp.bytes_skipped,
+            "failed": [f.path for f in gdcp.failures["HTTP"]],
+            "md5_failed": [f.path for f in gdcp.failures["MD5"]]}
+
+def lpt_seconds(seconds, workers):
+    """
+    Return when the last of workers would finish if tasks taking seconds,
+    sorted longest first, are each given to the worker that is free first
+    """
+    loads = [0.0] * max(workers, 1)
+    for t in seconds:
+        heapq.heapreplace(loads, loads[0] + t)
+    return max(loads)
+
+def byte_ranges(size, chunksize):
+    """
+    Return list of inclusive (start, end) byte ranges covering size bytes in
+    pieces of at most chunksize bytes.
+    """
+    return [(start, min(start + chunksize, size) - 1)
+            for start in xrange(0, size, chunksize)]
+
+def local_matches(path, metadata):
+    """
+    Return True if the local file at path has the size and MD5 checksum in
+    Drive file metadata.
+    """
+    try:
+        if os.path.getsize(path) != int(metadata.get("fileSize", -1)):
+            return False
+        return file_md5(path) == metadata.get("md5Checksum")
+    except (OSError, IOError):
+        return False
+
+def is_sync_match(metadata):
+    """
+    Return True if the Drive file in metadata can be synced with a local file
+    or folder of the same title. Google Apps documents can't: they have no
+    size or MD5 to compare, and updating one with local content would
+    overwrite it.
+    """
+    mimetype = metadata["mimeType"]
+    return (mimetype == "application/vnd.google-apps.folder" or
+        not mimetype.startswith("application/vnd.google-apps."))
+
+def query_escape(value):
+    """
+    Return value escaped for a string literal in a Drive search query
+    """
+    return value.replace("\\", "\\\\").replace("'", "\\'")
+
+def unique(items):
+    """
+    Return list of items without duplicates, in their original order
+    """
+    seen = set()
+    return [i for i in items if not (i in seen or seen.add(i))]
+
+def listing_line(title, gid, mimetype, fileSize=None, md5Checksum=None,
+    predecessors=""):
+    """
+    Return the line list prints for a file: title (after predecessors), id,
+    type (file, folder or the Google Apps doc type), and for files fileSize
+    and md5Checksum, separated by tabs
+    """
+    if predecessors:
+        title = predecessors + "/" + remove_r_n(title)
+    else:
+        title = remove_r_n(title)
+    line = [title, gid]
+    if mimetype == "application/vnd.google-apps.folder":
+        line.append("folder")
+    elif mimetype.startswith("application/vnd.google-apps."):
+        line.append(mimetype.split("application/vnd.google-apps.")[-1])
+    else:
+        line.append("file")
+        line.append(str(fileSize))
+        line.append(md5Checksum)
+    return "\t".join(line)
+
+def merge_ranges(ranges):
+    """
+    Return sorted list of inclusive (start, end) ranges with overlapping and
+    adjacent ranges merged.
     """
-    headers = {
-        "range": "bytes=%i-%i" % (bytes_start, bytes_end),
-        "content-type": "application/octet-stream"
-    }
-    # Returns [response, content]
-    return h.request(url, method="GET", headers=headers)
+    merged = []
+    for start, end in sorted([tuple(r) for r in ranges]):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+def file_md5(path, blocksize=2 ** 20):
+    """
+    Return hex MD5 digest of the file at path
+    """
+    md5 = hashlib.md5()
+    with open(path, "rb") as fh:
+        while True:
+            block = fh.read(blocksize)
+            if not block:
+                break
+            md5.update(block)
+    return md5.hexdigest()
 
 def delay(retries):
     return (2 ** retries) + random.random()
@@ -1231,21 +3717,27 @@ def parse_file_args(file_args):
             files.append(f)
     return files
 
+# Serializes writes to STDOUT from worker threads
+stdout_lock = threading.Lock()
+
 def stdoutr(msg=""):
     """Rewrite current line on STDOUT with no terminating newline"""
-    sys.stdout.write("\r%s" % (" " * 79))  # wipe line
-    sys.stdout.write("\r%s" % msg)
-    sys.stdout.flush()
+    with stdout_lock:
+        sys.stdout.write("\r%s" % (" " * 79))  # wipe line
+        sys.stdout.write("\r%s" % msg)
+        sys.stdout.flush()
 
 def stdoutn(msg=""):
     """Write to STDOUT with terminating newline"""
-    sys.stdout.write("%s\n" % msg)
-    sys.stdout.flush()
+    with stdout_lock:
+        sys.stdout.write("%s\n" % msg)
+        sys.stdout.flush()
 
 def stdout(msg=""):
     """Write to STDOUT with no terminating newline"""
-    sys.stdout.write("%s" % msg)
-    sys.stdout.flush()
+    with stdout_lock:
+        sys.stdout.write("%s" % msg)
+        sys.stdout.flush()
 
 # -----------------------------------------------------------------------------
 # Command-line interface functions
@@ -1264,6 +3756,39 @@ def cli():
         default=False,
         action="store_true",
         help="Verbose logging output")
+    parent.add_argument(
+        "--cache_ttl",
+        default=0,
+        type=int,
+        help="""Cache Drive file metadata and folder listings in
+             ~/.%s/metadata.sqlite for this many seconds. 0 disables the
+             cache.""" % PROJ)
+    parent.add_argument(
+        "--qps",
+        default=QPS,
+        type=float,
+        help="""Most Drive API calls per second on average. The rate is
+             halved while Drive reports rate limit errors. 0 disables
+             limiting.""")
+    parent.add_argument(
+        "--burst",
+        default=BURST,
+        type=int,
+        help="""Most Drive API calls at once after a quiet period""")
+
+    # Options for commands that transfer file contents
+    transfer = ArgumentParser(add_help=False)
+    transfer.add_argument(
+        "--chunksize",
+        default=0,
+        type=int,
+        help="""Fixed chunk size in MiB for every upload and download request.
+             0 adapts the chunk size of each file to its transfer rate.""")
+    transfer.add_argument(
+        "--chunk_budget",
+        default=CHUNK_BUDGET // 2 ** 20,
+        type=int,
+        help="""Most MiB of chunks in flight at once across all files""")
 
     parser = ArgumentParser(
         description="Google Drive command-line interface",
@@ -1307,6 +3832,25 @@ def cli():
         action="store_true",
         help="""List all files except for trashed. Much faster than specifying
                 a large -d value.""")
+    parser_list.add_argument(
+        "--jobs",
+        default=1,
+        type=int,
+        help="""Number of folders to fetch at once for a recursive listing.
+             Output is the same, but printed once the listing is complete.""")
+    parser_list.add_argument(
+        "--index",
+        default=False,
+        action="store_true",
+        help="""Index all files with one flat listing first, as -a does, and
+             answer a recursive listing from the index. Faster than a large
+             -d value for big trees.""")
+    parser_list.add_argument(
+        "--size",
+        default=False,
+        action="store_true",
+        help="""Print title, id, number of files and total bytes below each
+             file or folder instead of a listing. Uses --index.""")
     parser_list.add_argument(
         "-i", "--id",
         default=[],
@@ -1324,7 +3868,7 @@ def cli():
     parser_mkdir.add_argument(
         "-p", "--path",
         default=None,
-        help="""folder path using form X/Y/Z must be specified. Front slashes indicate subdirectory name.""")
+        help="""folder path using form X/Y/Z must be specified. Front slashes indicate subdirectory name. - to read many paths from STDIN, one per line.""")
     parser_mkdir.add_argument( 
         "-i", "--id", 
         default = "root",
@@ -1350,6 +3894,13 @@ def cli():
         "-p", "--parent", 
         default = "root",
         help="""Parent ID, i.e. containing folder ID, where to copy the file to. If no ID is specified, the file will be placed in root folder.""")
+    parser_copy.add_argument(
+        "-m", "--manifest",
+        default=None,
+        type=FileType('r'),
+        help="""Copy many files listed in this file, - for STDIN. Each line
+             is a file ID, new file name and parent ID separated by tabs.
+             Lines without a parent ID use -p.""")
     parser_copy.set_defaults(func=cli_copy)
     # MOVE - CJK added
     parser_move = subparsers.add_parser(
@@ -1385,12 +3936,31 @@ def cli():
         help="""File ID. Must be specified.""")
     parser_delete.set_defaults(func=cli_delete)
 
+    # Cache
+    parser_cache = subparsers.add_parser(
+        "cache",
+        help="""Invalidate entries in the metadata cache (see --cache_ttl)""",
+        formatter_class=ArgumentDefaultsHelpFormatter,
+        parents=[parent])
+    parser_cache.add_argument(
+        "-i", "--id",
+        default=[],
+        action="append",
+        help="""File or folder ID to drop from the cache. - to read a list of
+             IDs from STDIN.""")
+    parser_cache.add_argument(
+        "--clear",
+        default=False,
+        action="store_true",
+        help="""Drop all cached metadata""")
+    parser_cache.set_defaults(func=cli_cache)
+
     # Download
     parser_download = subparsers.add_parser(
         "download",
         help="Download files from Google Drive. Google Docs are skipped.",
         formatter_class=ArgumentDefaultsHelpFormatter,
-        parents=[parent])
+        parents=[parent, transfer])
     parser_download.add_argument(
         "-i", "--id",
         default=[],
@@ -1418,17 +3988,72 @@ def cli():
         action="store_true",
         default=False,
         help="""Apply exclude rules to folder titles in addition to file titles""")
+    parser_download.add_argument(
+        "--jobs",
+        default=1,
+        type=int,
+        help="""Number of files to download at once""")
+    parser_download.add_argument(
+        "--segments",
+        default=1,
+        type=int,
+        help="""Number of byte ranges to download at once for each file larger
+             than one chunk""")
+    parser_download.add_argument(
+        "--index",
+        default=False,
+        action="store_true",
+        help="""Index all files with one flat listing first instead of listing
+             each folder""")
     parser_download.add_argument(
         "target",
         help="Destination directory")
     parser_download.set_defaults(func=cli_download)
 
+    # Sync
+    parser_sync = subparsers.add_parser(
+        "sync",
+        help="""Download or upload only files that are new or changed. Files
+        are compared by size and MD5 checksum. Existing folders are reused and
+        changed files are replaced (uploads become new revisions).""",
+        formatter_class=ArgumentDefaultsHelpFormatter,
+        parents=[parent, transfer])
+    parser_sync.add_argument(
+        "direction",
+        choices=["download", "upload"],
+        help="""download syncs Drive folder ID into local folder path. upload
+             syncs local file/folder path into Drive folder ID.""")
+    parser_sync.add_argument(
+        "-i", "--id",
+        default="root",
+        help="""Drive file or folder ID""")
+    parser_sync.add_argument(
+        "-n", "--no_checksum",
+        default=False,
+        action="store_true",
+        help="Skip MD5 checksum verification after transfer")
+    parser_sync.add_argument(
+        "--jobs",
+        default=1,
+        type=int,
+        help="""Number of files to transfer at once""")
+    parser_sync.add_argument(
+        "--multipart_size",
+        default=MULTIPART_SIZE // 2 ** 10,
+        type=int,
+        help="""Upload files up to this many KiB with their metadata in one
+             request. Larger files use resumable upload sessions.""")
+    parser_sync.add_argument(
+        "path",
+        help="Local destination folder for download, or file/folder to upload")
+    parser_sync.set_defaults(func=cli_sync)
+
     # Upload
     parser_upload = subparsers.add_parser(
         "upload",
         help="Upload files to Google Drive",
         formatter_class=ArgumentDefaultsHelpFormatter,
-        parents=[parent])
+        parents=[parent, transfer])
     parser_upload.add_argument(
         "-p", "--parent",
         default="root",
@@ -1440,6 +4065,19 @@ def cli():
         default=False,
         action="store_true",
         help="Skip MD5 checksum verification after upload")
+    parser_upload.add_argument(
+        "--jobs",
+        default=1,
+        type=int,
+        help="""Number of files to upload at once. Folders are created in
+             the background, a level at a time, and each file starts as soon
+             as its folder exists.""")
+    parser_upload.add_argument(
+        "--multipart_size",
+        default=MULTIPART_SIZE // 2 ** 10,
+        type=int,
+        help="""Upload files up to this many KiB with their metadata in one
+             request. Larger files use resumable upload sessions.""")
     parser_upload.add_argument(
         "-t", "--title",
         help="""Title for file/folder. Must be specified if folder is '.' or
@@ -1489,46 +4127,124 @@ def cli():
 
     args = parser.parse_args()
     configure_logging(args.log, args.verbose)
+    if args.qps < 0:
+        error("--qps must be >= 0")
+    if args.burst < 1:
+        error("--burst must be >= 1")
+    rate_limiter.configure(args.qps, args.burst)
 
-    if args.subcommand_name != "version":
+    if args.subcommand_name not in ["version", "cache"]:
         args.drive = create_GoogleDrive()  # add GoogleDrive
     args.func(args)
 
+def open_cache(args):
+    """
+    Return MetadataCache for args.cache_ttl, or None if there's no cache to
+    read or keep up to date.
+    """
+    location = os.path.join(os.environ["HOME"], "." + PROJ, "metadata.sqlite")
+    if args.cache_ttl > 0 or os.path.exists(location):
+        return MetadataCache(location, ttl=args.cache_ttl)
+    return None
+
+def open_chunks(args):
+    """
+    Return ChunkSizer for the --chunksize and --chunk_budget options
+    """
+    if args.chunksize < 0:
+        error("--chunksize must be >= 0")
+    if args.chunk_budget < 1:
+        error("--chunk_budget must be >= 1")
+    return ChunkSizer(fixed=args.chunksize * 2 ** 20,
+        budget=args.chunk_budget * 2 ** 20)
+
+def multipart_size(args):
+    """
+    Return the largest file size in bytes to upload in one request for the
+    --multipart_size option
+    """
+    if args.multipart_size < 0:
+        error("--multipart_size must be >= 0")
+    return args.multipart_size * 2 ** 10
+
 def cli_list(args):
     ids = parse_id_args(args.id)
-    gdcp = Gdcp(args.drive)
+    if args.jobs < 1:
+        error("list --jobs must be >= 1")
+    gdcp = Gdcp(args.drive, cache=open_cache(args), jobs=args.jobs,
+        full_metadata=args.json)
     if args.depth < 0:
         error("list -d must be >= 0")
+    if args.json and (args.index or args.size):
+        error("list -j can't be used with --index or --size")
+    if len(ids) == 0:
+        ids.append("root")
     if args.all:  # start at root
         gdcp.list_all_files(json_flag=args.json)
+    elif args.size:
+        gdcp.sizes(ids)
     else:
-        if len(ids) == 0:
-            ids.append("root")
+        if args.index:
+            gdcp.build_index()
         gdcp.list(ids=ids, json_flag=args.json, depth=args.depth)
 
 def cli_delete(args): #CJK added
     ids = parse_id_args(args.id)
-    gdcp = Gdcp(args.drive)
+    gdcp = Gdcp(args.drive, cache=open_cache(args))
     gdcp.delete(ids=ids)
 
 def cli_updateParent(args): #CJK added (for file move)
     ids = parse_id_args(args.id)
-    gdcp = Gdcp(args.drive)
+    gdcp = Gdcp(args.drive, cache=open_cache(args))
     gdcp.move(parent=args.parent,ids=ids,linkIt=args.linkIt)
 
 def cli_copy(args): #CJK added (for file copy)
     ids = parse_id_args(args.id)
-    gdcp = Gdcp(args.drive)
-    gdcp.copy(parent=args.parent,copy_name=args.copy_name,ids=ids)
+    gdcp = Gdcp(args.drive, cache=open_cache(args))
+    if args.manifest:
+        gdcp.copy_manifest(parse_copy_manifest(args.manifest, args.parent))
+    else:
+        gdcp.copy(parent=args.parent,copy_name=args.copy_name,ids=ids)
+
+def parse_copy_manifest(manifest_file, parent):
+    """
+    Return list of (id, new name, parent id) from tab separated lines of
+    manifest_file. parent is used for lines without a parent ID.
+    """
+    manifest = []
+    for line in manifest_file:
+        line = line.rstrip("\r\n")
+        if not line.strip():
+            continue
+        parts = line.split("\t")
+        if len(parts) == 2:
+            parts.append(parent)
+        if len(parts) != 3 or not parts[1]:
+            error("Bad copy manifest line: %s" % line)
+        manifest.append(tuple(parts))
+    return manifest
 
 def cli_mkdir(args): #CJK added (for file copy)
-    gdcp = Gdcp(args.drive)
-    gdcp.mkdir(path_name=args.path,parent=args.id)
+    gdcp = Gdcp(args.drive, cache=open_cache(args))
+    if not args.path:
+        error("mkdir -p must be specified")
+    if args.path == "-":
+        path_names = [line.strip() for line in sys.stdin if line.strip()]
+    else:
+        path_names = [args.path]
+    gdcp.mkdirs(path_names=path_names, parent=args.id)
 
 def cli_download(args):
+    if args.jobs < 1:
+        error("download --jobs must be >= 1")
+    if args.segments < 1:
+        error("download --segments must be >= 1")
     gdcp = Gdcp(args.drive, excludes=args.excludes, include=args.invert_excludes,
-        exclude_folders=args.exclude_folders)
+        exclude_folders=args.exclude_folders, jobs=args.jobs, segments=args.segments,
+        cache=open_cache(args), chunks=open_chunks(args))
     ids = parse_id_args(args.id)
+    if args.index:
+        gdcp.build_index()
     gdcp.download(ids=ids, checksum=not args.no_checksum, root=args.target)
     if gdcp.failed():
         gdcp.print_failed()
@@ -1538,8 +4254,11 @@ def cli_download(args):
         log.info("Downloaded %i file(s) and folder(s)" % gdcp.file_count)
 
 def cli_upload(args):
+    if args.jobs < 1:
+        error("upload --jobs must be >= 1")
     gdcp = Gdcp(args.drive, excludes=args.excludes, include=args.invert_excludes,
-        exclude_folders=args.exclude_folders)
+        exclude_folders=args.exclude_folders, jobs=args.jobs, cache=open_cache(args),
+        chunks=open_chunks(args), multipart_size=multipart_size(args))
     files = parse_file_args(args.files)
     gdcp.upload(paths=files, title=args.title, parent=args.parent,
         checksum=not args.no_checksum)
@@ -1550,6 +4269,37 @@ def cli_upload(args):
         stdoutn("Uploaded %i file(s) and folder(s)" % gdcp.file_count)
         log.info("Uploaded %i file(s) and folder(s)" % gdcp.file_count)
 
+def cli_sync(args):
+    if args.jobs < 1:
+        error("sync --jobs must be >= 1")
+    gdcp = Gdcp(args.drive, jobs=args.jobs, cache=open_cache(args), sync=True,
+        chunks=open_chunks(args), multipart_size=multipart_size(args))
+    if args.direction == "download":
+        gdcp.download(ids=[args.id], checksum=not args.no_checksum, root=args.path)
+    else:
+        gdcp.upload(paths=[args.path], parent=args.id, checksum=not args.no_checksum)
+    msg = ("Transferred %i file(s) and folder(s), %i bytes. Skipped %i unchanged "
+           "file(s), %i bytes." % (gdcp.file_count, gdcp.bytes_transferred,
+           gdcp.skipped_count, gdcp.bytes_skipped))
+    if gdcp.failed():
+        gdcp.print_failed()
+        stdoutn(msg)
+        sys.exit(1)
+    else:
+        stdoutn(msg)
+        log.info(msg)
+
+def cli_cache(args):
+    cache = open_cache(args)
+    if not cache:
+        return
+    if args.clear:
+        cache.clear()
+    for _id in parse_id_args(args.id):
+        # Listing first, while an alias like "root" can still be resolved
+        cache.invalidate_children(find_id(_id))
+        cache.invalidate(find_id(_id))
+
 def cli_transfer_ownership(args):
     gdcp = Gdcp(args.drive)
     ids = parse_id_args(args.id)
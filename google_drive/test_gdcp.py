@@ -1,7 +1,10 @@
-import unittest, sys, os
+import unittest, sys, os, shutil, tempfile, json, threading, hashlib, time, BaseHTTPServer, SocketServer
 #import the db interface in the DB directory in parent dir 
 sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'google_drive'))
 import gdcp
+import apiclient.errors
+import apiclient.http
+import httplib2
 
 class GDCPTest(unittest.TestCase):
     def test_find_id(self):
@@ -37,5 +40,742 @@ class GDCPTest(unittest.TestCase):
         answers = [gdcp.find_id(x) for x in ids]
         self.assertListEqual(answers, correct_answers)
 
+    def test_byte_ranges(self):
+        """
+        Test splitting a file size into download ranges
+        """
+        self.assertListEqual(gdcp.byte_ranges(0, 7), [])
+        self.assertListEqual(gdcp.byte_ranges(14, 7), [(0, 6), (7, 13)])
+        self.assertListEqual(gdcp.byte_ranges(15, 7), [(0, 6), (7, 13), (14, 14)])
+
+    def test_metadata_cache(self):
+        """
+        Test metadata cache lookups, staleness and invalidation
+        """
+        cache = gdcp.MetadataCache(":memory:", ttl=60)
+        folder = {"id": "f1", "title": "folder"}
+        child = {"id": "c1", "title": "child", "parents": [{"id": "f1"}]}
+        cache.put(folder, alias="root")
+        cache.put_children("f1", [child])
+        self.assertEqual(cache.get("root"), folder)
+        self.assertListEqual(cache.get_children("f1"), [child])
+        cache.invalidate("c1")
+        self.assertEqual(cache.get_children("f1"), None)
+        cache.put_children("f1", [child])
+        cache.invalidate_children("root")
+        self.assertEqual(cache.get_children("f1"), None)
+        self.assertEqual(cache.get("c1"), child)
+        cache.ttl = -1
+        self.assertEqual(cache.get("c1"), None)
+
+    def test_metadata_cache_full(self):
+        """
+        Test that projected metadata doesn't satisfy lookups for full metadata
+        """
+        cache = gdcp.MetadataCache(":memory:", ttl=60)
+        child = {"id": "c1", "title": "child"}
+        cache.put_children("f1", [child])
+        self.assertListEqual(cache.get_children("f1"), [child])
+        self.assertEqual(cache.get_children("f1", full=True), None)
+        self.assertEqual(cache.get("c1", full=True), None)
+        full = dict(child, kind="drive#file")
+        cache.put_children("f1", [full], full=True)
+        self.assertListEqual(cache.get_children("f1", full=True), [full])
+        self.assertEqual(cache.get("c1"), full)
+
+    def test_drive_index(self):
+        """
+        Test folder lookups and size totals from the index
+        """
+        folder = "application/vnd.google-apps.folder"
+        index = gdcp.DriveIndex()
+        index.add({"id": "r", "title": "My Drive", "mimeType": folder},
+            alias="root")
+        index.add({"id": "d", "title": "d", "mimeType": folder,
+            "parents": [{"id": "r"}]})
+        index.add({"id": "b", "title": "b", "mimeType": "text/plain",
+            "fileSize": "3", "md5Checksum": "x", "parents": [{"id": "d"}]})
+        index.add({"id": "a", "title": "a", "mimeType": "text/plain",
+            "fileSize": "5", "md5Checksum": "y",
+            "parents": [{"id": "d"}, {"id": "r"}]})
+        index.add({"id": "g", "title": "g",
+            "mimeType": "application/vnd.google-apps.document",
+            "parents": [{"id": "r"}]})
+        self.assertListEqual([r.id for r in index.list_children("root")],
+            ["a", "d", "g"])
+        self.assertEqual(index.size("root"), (2, 8))
+        self.assertEqual(index.size("d"), (2, 8))
+        self.assertEqual(index.get("b").metadata()["fileSize"], "3")
+        self.assertFalse(hasattr(index.get("b"), "__dict__"))
+        self.assertEqual(gdcp.listing_line("b", "b", "text/plain", 3, "x", "d"),
+            "d/b\tb\tfile\t3\tx")
+        self.assertEqual(gdcp.listing_line("g", "g",
+            "application/vnd.google-apps.document"), "g\tg\tdocument")
+
+    def test_path_cache(self):
+        """
+        Test path cache lookups and invalidation
+        """
+        paths = gdcp.PathCache()
+        paths.add("p", "a", "id1")
+        paths.add("p", "a", "id2")
+        paths.add("q", "a", "id1")
+        paths.add_listing("p")
+        self.assertEqual(paths.get("p", "a"), "id1")
+        self.assertTrue(paths.is_listed("p"))
+        paths.invalidate("id1", "p")
+        self.assertEqual(paths.get("p", "a"), None)
+        self.assertEqual(paths.get("q", "a"), None)
+        self.assertFalse(paths.is_listed("p"))
+
+    def test_folder_plan(self):
+        """
+        Test reserved folder ids, creation level by level, failures of
+        folders below one that couldn't be created, and waiting on folders
+        """
+        def http_error(status):
+            return apiclient.errors.HttpError(httplib2.Response({"status": status}), "")
+        inserts = []
+        class Request(object):
+            def __init__(self, ids=None, body=None):
+                self.ids = ids
+                self.body = body
+            def execute(self, http=None):
+                return {"ids": self.ids}
+        class Files(object):
+            def generateIds(self, maxResults, space):
+                return Request(ids=["id%i" % i for i in range(maxResults)])
+            def insert(self, body):
+                return Request(body=body)
+        class Service(object):
+            def files(self):
+                return Files()
+        class Auth(object):
+            service = Service()
+        class Drive(object):
+            auth = Auth()
+        class Gdcp(object):
+            drive = Drive()
+            created = 0
+            raise_at = None
+            def execute_batch(self, requests):
+                results = []
+                for key, request in requests:
+                    title = request.body["title"]
+                    if title == self.raise_at:
+                        raise ValueError(title)
+                    inserts.append(title)
+                    if title == "bad":
+                        results.append((key, None, http_error(500)))
+                    elif title == "retried":
+                        results.append((key, None, http_error(409)))
+                    else:
+                        results.append((key, dict(request.body), None))
+                return results
+            def count_file(self):
+                self.created += 1
+        class Folder(object):
+            def __init__(self, title, parent):
+                self.title = title
+                self.path = title
+                self.parent = parent
+                self.metadata = None
+                self.failed = False
+            def _create_body(self):
+                return {"title": self.title, "parents": [{"id": self.parent}]}
+            def _created_google_folder(self, response):
+                self.metadata = response
+            def _fail_upload(self):
+                self.failed = True
+
+        def plan(g):
+            folders = gdcp.FolderPlan(g)
+            tree = {}
+            for title, parent in [("a", None), ("bad", None), ("a1", "a"),
+                    ("retried", "a"), ("bad1", "bad"), ("a2", "a1"),
+                    ("bad2", "bad1")]:
+                tree[title] = Folder(title, tree[parent].id if parent else "root")
+                folders.add(tree[title])
+            return folders, tree
+
+        g = Gdcp()
+        folders, tree = plan(g)
+        self.assertListEqual([tree["a"].id, tree["bad"].id, tree["a1"].id],
+            ["id0", "id1", "id2"])
+        self.assertListEqual([[f.title for f in level] for level in folders.levels],
+            [["a", "bad"], ["a1", "retried", "bad1"], ["a2", "bad2"]])
+        waiters = []
+        for title in ["a2", "bad2"]:
+            result = []
+            t = threading.Thread(target=lambda r=result, gid=tree[title].id:
+                r.append(folders.wait(gid)))
+            t.start()
+            waiters.append((t, result))
+        folders.create()
+        for t, result in waiters:
+            t.join(5)
+            self.assertFalse(t.is_alive())
+        self.assertListEqual([r for t, r in waiters], [[True], [False]])
+        self.assertListEqual(inserts, ["a", "bad", "a1", "retried", "a2"])
+        self.assertListEqual(sorted(t for t, f in tree.items() if f.failed),
+            ["bad", "bad1", "bad2"])
+        self.assertEqual(tree["retried"].metadata["title"], "retried")
+        self.assertEqual(g.created, 4)
+        self.assertTrue(folders.wait("root"))
+
+        # A batch that raises still releases every waiter
+        g = Gdcp()
+        g.raise_at = "a1"
+        folders, tree = plan(g)
+        self.assertRaises(ValueError, folders.create)
+        self.assertTrue(folders.wait(tree["a"].id))
+        self.assertFalse(folders.wait(tree["a2"].id))
+
+    def test_query_escape(self):
+        """
+        Test escaping of quotes and backslashes in search query literals
+        """
+        self.assertEqual(gdcp.query_escape("it's"), "it\\'s")
+        self.assertEqual(gdcp.query_escape("a\\b"), "a\\\\b")
+
+    def test_is_sync_match(self):
+        """
+        Test that syncing never matches local files to Google Apps documents
+        """
+        self.assertTrue(gdcp.is_sync_match({"mimeType": "text/plain"}))
+        self.assertTrue(gdcp.is_sync_match(
+            {"mimeType": "application/vnd.google-apps.folder"}))
+        for doctype in ["document", "spreadsheet", "presentation"]:
+            self.assertFalse(gdcp.is_sync_match(
+                {"mimeType": "application/vnd.google-apps." + doctype}))
+
+    def test_sync_decisions(self):
+        """
+        Test that syncing skips files that match their Drive copy, uploads
+        changed ones as new revisions and removes a skipped download's state
+        """
+        md5 = "6f5902ac237024bdd0c176cb93063dc4"
+        requests = []
+        class Request(object):
+            def __init__(self, method, fileId=None, body=None, media_body=None):
+                requests.append((method, fileId))
+                self.fileId = fileId
+                self.body = body
+                self.media_body = media_body
+            def execute(self, http=None):
+                data = self.media_body.getbytes(0, self.media_body.size())
+                return {"id": self.fileId or "new", "title": self.body["title"],
+                    "mimeType": self.body["mimeType"], "fileSize": str(len(data)),
+                    "md5Checksum": hashlib.md5(data).hexdigest()}
+        class Get(object):
+            def execute(self, http=None):
+                return remote
+        class Files(object):
+            def get(self, fileId, fields=None):
+                return Get()
+            def insert(self, body, media_body=None):
+                return Request("insert", body=body, media_body=media_body)
+            def update(self, fileId, body, media_body=None):
+                return Request("update", fileId, body, media_body)
+        class Service(object):
+            _http = None
+            def files(self):
+                return Files()
+        class Auth(object):
+            service = Service()
+            credentials = None
+            def Get_Http_Object(self):
+                return None
+        class Drive(object):
+            auth = Auth()
+
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, "f")
+        with open(path, "wb") as fh:
+            fh.write("hello world\n")
+        remote = {"id": "r", "title": "f", "mimeType": "text/plain",
+            "fileSize": "12", "md5Checksum": md5}
+        self.assertTrue(gdcp.local_matches(path, remote))
+        self.assertFalse(gdcp.local_matches(path, dict(remote, fileSize="13")))
+        self.assertFalse(gdcp.local_matches(path, dict(remote, md5Checksum="x")))
+        self.assertFalse(gdcp.local_matches(path + "x", remote))
+
+        g = gdcp.Gdcp(Drive(), sync=True, quiet=True)
+        f = gdcp.GdcpFile(g, path=path, parent="p")
+        f.remote = remote
+        f._upload_file()
+        self.assertEqual((g.skipped_count, g.bytes_skipped, g.file_count), (1, 12, 0))
+        self.assertListEqual(requests, [])
+        f = gdcp.GdcpFile(g, path=path, parent="p")
+        f.remote = dict(remote, md5Checksum="x")
+        f._upload_file()
+        self.assertListEqual(requests, [("update", "r")])
+        self.assertEqual((g.skipped_count, g.file_count), (1, 1))
+        self.assertFalse(g.failed())
+
+        # A matching download, with state left by an interrupted walk
+        state = gdcp.DownloadState(path, "r", md5, 12)
+        state.save()
+        g.download(["r"], root=tmpdir)
+        self.assertEqual((g.skipped_count, g.bytes_skipped, g.file_count), (2, 24, 1))
+        self.assertEqual(gdcp.DownloadState.load(path), None)
+        self.assertListEqual(os.listdir(tmpdir), ["f"])
+        os.remove(path)
+        os.rmdir(tmpdir)
+
+    def test_record_walks(self):
+        """
+        Test that downloads and listings walk FileRecords, and that pending
+        downloads keep only their record and reserved path
+        """
+        class Auth(object):
+            credentials = None
+            def Get_Http_Object(self):
+                return None
+        class Drive(object):
+            auth = Auth()
+        folder = "application/vnd.google-apps.folder"
+        index = gdcp.DriveIndex()
+        index.add({"id": "d", "title": "d", "mimeType": folder})
+        index.add({"id": "s", "title": "s", "mimeType": folder,
+            "parents": [{"id": "d"}]})
+        for gid, parent in [("b", "d"), ("a", "s"), ("c", "s")]:
+            index.add({"id": gid, "title": "f", "mimeType": "text/plain",
+                "fileSize": str(ord(gid)), "md5Checksum": gid,
+                "parents": [{"id": parent}]})
+        index.add({"id": "g", "title": "g", "parents": [{"id": "d"}],
+            "mimeType": "application/vnd.google-apps.document"})
+        g = gdcp.Gdcp(Drive(), quiet=True)
+        g.index = index
+        tmpdir = tempfile.mkdtemp()
+        pending = []
+        g._download_record(index.get("d"), tmpdir, pending=pending)
+        self.assertTrue(all(type(p) is gdcp.PendingDownload for p in pending))
+        self.assertListEqual([(p.record.id, os.path.relpath(p.path, tmpdir), p.fileSize)
+            for p in pending], [("b", "d/f", 98), ("a", "d/s/f", 97),
+            ("c", "d/s/f_duplicate_1", 99)])
+        self.assertEqual(gdcp.DownloadState.load(pending[2].path).id, "c")
+
+        listings = []
+        stdout = sys.stdout
+        for jobs in [1, 3]:
+            g.jobs = jobs
+            sys.stdout = tempfile.TemporaryFile()
+            try:
+                g.list(["d"], depth=1)
+                sys.stdout.seek(0)
+                listings.append(sys.stdout.read().splitlines())
+            finally:
+                sys.stdout.close()
+                sys.stdout = stdout
+        self.assertListEqual(listings[0], ["d\td\tfolder", "d/f\tb\tfile\t98\tb",
+            "d/g\tg\tdocument", "d/s\ts\tfolder", "d/s/f\ta\tfile\t97\ta",
+            "d/s/f\tc\tfile\t99\tc"])
+        self.assertListEqual(listings[1], listings[0])
+        shutil.rmtree(tmpdir)
+
+    def test_download_state(self):
+        """
+        Test recording, saving and resuming partial download ranges
+        """
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, "f")
+        state = gdcp.DownloadState(path, "id", "md5", 30)
+        self.assertListEqual(state.missing(10), [(0, 9), (10, 19), (20, 29)])
+        state.record(10, 19)
+        state.record(25, 26)
+        state.record(20, 24)
+        self.assertListEqual(state.ranges, [(10, 26)])
+        loaded = gdcp.DownloadState.load(path)
+        self.assertListEqual(loaded.missing(6), [(0, 5), (6, 9), (27, 29)])
+        self.assertEqual(loaded.bytes_done(), 17)
+        loaded.record(0, 9)
+        loaded.record(27, 29)
+        loaded.remove()
+        self.assertEqual(gdcp.DownloadState.load(path), None)
+        os.rmdir(tmpdir)
+
+    def test_download_state_find(self):
+        """
+        Test finding a partial download saved under a de-duplicated name
+        """
+        r = gdcp.FileRecord("id", "f", "text/plain", 30, "md5")
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, "f")
+        self.assertEqual(gdcp.DownloadState.find(r, path), None)
+        other = gdcp.DownloadState(path, "other", "md5", 30)
+        open(path, "wb").close()
+        other.save()
+        duplicate = gdcp.de_duplicate_path_name(path)
+        state = gdcp.DownloadState(duplicate, "id", "md5", 30, [(0, 9)])
+        open(duplicate, "wb").close()
+        state.save()
+        found = gdcp.DownloadState.find(r, path)
+        self.assertEqual(found.path, path + "_duplicate_1")
+        self.assertListEqual(found.ranges, [(0, 9)])
+        r.fileSize = 31
+        self.assertEqual(gdcp.DownloadState.find(r, path), None)
+        for s in [other, state]:
+            s.remove()
+            os.remove(s.path)
+        os.rmdir(tmpdir)
+
+    def test_file_md5(self):
+        """
+        Test MD5 calculation for a local file
+        """
+        with tempfile.NamedTemporaryFile() as fh:
+            fh.write("hello world\n")
+            fh.flush()
+            self.assertEqual(gdcp.file_md5(fh.name, blocksize=4),
+                             "6f5902ac237024bdd0c176cb93063dc4")
+
+    def test_mmap_media_upload(self):
+        """
+        Test chunks and inline MD5 of the mmap upload source, including a
+        resent chunk and a jump ahead as when resuming an upload
+        """
+        with tempfile.NamedTemporaryFile() as fh:
+            fh.write("hello world\n")
+            fh.flush()
+            media = gdcp.MmapMediaUpload(fh.name, chunksize=5, resumable=True)
+            self.assertEqual(media.size(), 12)
+            self.assertEqual(str(media.getbytes(0, 5)), "hello")
+            self.assertEqual(media.md5(), None)
+            self.assertEqual(str(media.getbytes(0, 5)), "hello")
+            self.assertEqual(str(media.getbytes(10, 5)), "d\n")
+            self.assertEqual(media.md5(), "6f5902ac237024bdd0c176cb93063dc4")
+            media.close()
+            media = gdcp.MmapMediaUpload(fh.name, resumable=False)
+            self.assertIsInstance(media.getbytes(0, media.size()), str)
+            self.assertEqual(media.md5(), "6f5902ac237024bdd0c176cb93063dc4")
+            media.close()
+
+    def test_resume_upload_session(self):
+        """
+        Test querying a resumable upload session and continuing the request
+        from the committed offset
+        """
+        class Http(object):
+            def __init__(self, *responses):
+                self.responses = list(responses)
+                self.requests = []
+            def request(self, uri, method="GET", body=None, headers=None, **kwargs):
+                self.requests.append((uri, method, headers, body and str(body)))
+                status, extra, content = self.responses.pop(0)
+                extra["status"] = str(status)
+                return httplib2.Response(extra), content
+        http = Http((404, {}, ""), (200, {}, '{"id": "x"}'), (308, {}, ""),
+            (308, {"range": "bytes=0-4"}, ""))
+        self.assertEqual(gdcp.upload_session_offset(http, "s", 12), None)
+        self.assertEqual(gdcp.upload_session_offset(http, "s", 12), (12, {"id": "x"}))
+        self.assertEqual(gdcp.upload_session_offset(http, "s", 12), (0, None))
+        self.assertEqual(gdcp.upload_session_offset(http, "s", 12), (5, None))
+        self.assertEqual(http.requests[-1][2]["Content-Range"], "bytes */12")
+        with tempfile.NamedTemporaryFile() as fh:
+            fh.write("hello world\n")
+            fh.flush()
+            media = gdcp.MmapMediaUpload(fh.name, chunksize=2 ** 18, resumable=True)
+            request = apiclient.http.HttpRequest(None, lambda resp, content:
+                json.loads(content), "insert", method="POST", resumable=media)
+            request.resumable_uri = "s"
+            request.resumable_progress = 5
+            http = Http((200, {}, '{"id": "x"}'))
+            self.assertEqual(request.next_chunk(http=http), (None, {"id": "x"}))
+            uri, method, headers, body = http.requests[0]
+            self.assertEqual((uri, method, body), ("s", "PUT", " world\n"))
+            self.assertEqual(headers["Content-Range"], "bytes 5-11/12")
+            self.assertEqual(media.md5(), "6f5902ac237024bdd0c176cb93063dc4")
+            media.close()
+
+    def test_is_retriable(self):
+        """
+        Test which API errors are retried
+        """
+        def http_error(status, reason=None):
+            content = json.dumps({"error": {"errors": [{"reason": reason}]}})
+            return apiclient.errors.HttpError(httplib2.Response({"status": status}), content)
+        self.assertTrue(gdcp.is_retriable(http_error(503)))
+        self.assertTrue(gdcp.is_retriable(http_error(429)))
+        self.assertTrue(gdcp.is_retriable(http_error(403, "userRateLimitExceeded")))
+        self.assertFalse(gdcp.is_retriable(http_error(403, "insufficientPermissions")))
+        self.assertFalse(gdcp.is_retriable(http_error(404)))
+        self.assertFalse(gdcp.is_retriable(ValueError()))
+        self.assertTrue(gdcp.is_rate_limited(http_error(403, "rateLimitExceeded")))
+        self.assertFalse(gdcp.is_rate_limited(http_error(503)))
+
+    def test_rate_limiter(self):
+        """
+        Test rate limiter slowdown and recovery
+        """
+        limiter = gdcp.RateLimiter(qps=1000, burst=10)
+        limiter.acquire(10)
+        self.assertLess(limiter.tokens, 1)
+        limiter.throttle()
+        limiter.throttle()  # at most one slowdown a second
+        self.assertEqual(limiter.rate, 500)
+        limiter.changed -= 3
+        limiter.acquire()
+        self.assertEqual(limiter.rate, 800)
+        limiter.changed -= 3
+        limiter.acquire()
+        self.assertEqual(limiter.rate, 1000)
+
+    def test_chunk_sizer(self):
+        """
+        Test chunk size adaptation, alignment and the chunk budget
+        """
+        align = gdcp.CHUNK_ALIGN
+        sizer = gdcp.ChunkSizer(budget=10 * align, initial=2 * align,
+            maximum=8 * align, target=1.0)
+        self.assertEqual(sizer.next_size(2 * align, 100 * align, 1.0), 4 * align)
+        self.assertEqual(sizer.next_size(8 * align, 100 * align, 1.0), 8 * align)
+        self.assertEqual(sizer.next_size(4 * align, align, 1.0), 2 * align)
+        self.assertEqual(sizer.next_size(4 * align, retried=True), 2 * align)
+        self.assertEqual(sizer.next_size(align, retried=True), align)
+        self.assertEqual(sizer.reserve(8 * align), 8 * align)
+        self.assertEqual(sizer.reserve(8 * align), 2 * align)
+        sizer.release(10 * align)
+        self.assertEqual(sizer.in_flight, 0)
+        transfer = sizer.transfer()
+        ranges = list(transfer.ranges([(0, 5 * align - 1)]))
+        self.assertListEqual(ranges, [(0, 2 * align - 1), (2 * align, 4 * align - 1),
+            (4 * align, 5 * align - 1)])
+        self.assertEqual(sizer.in_flight, 0)
+        fixed = gdcp.ChunkSizer(fixed=3 * align + 5)
+        self.assertEqual(fixed.next_size(3 * align, 100 * align, 1.0), 3 * align)
+
+    def test_download_stream(self):
+        """
+        Test streaming byte ranges into a file over one connection
+        """
+        data = os.urandom(5000)
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            def log_message(self, *args):
+                pass
+            def do_GET(self):
+                start, end = self.headers["range"].split("=")[1].split("-")
+                body = data[int(start):int(end) + 1]
+                self.send_response(206)
+                self.send_header("content-length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+        class Credentials(object):
+            def apply(self, headers):
+                headers["authorization"] = "Bearer token"
+        server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            url = "http://127.0.0.1:%i/f" % server.server_port
+            stream = gdcp.DownloadStream(Credentials(), bufsize=100)
+            md5 = hashlib.md5()
+            with tempfile.TemporaryFile() as fh:
+                for start, end in gdcp.byte_ranges(len(data), 1500):
+                    response, md5 = stream.fetch(url, start, end, fh, md5)
+                    self.assertEqual(response.status, 206)
+                fh.seek(0)
+                self.assertEqual(fh.read(), data)
+            self.assertEqual(md5.hexdigest(), hashlib.md5(data).hexdigest())
+            stream.close()
+        finally:
+            server.shutdown()
+            thread.join()
+
+    def test_download_stream_status(self):
+        """
+        Test that a 200 reply is only written for a range from byte 0 and
+        that threads refresh an expired token once
+        """
+        data = os.urandom(5000)
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            def log_message(self, *args):
+                pass
+            def do_GET(self):
+                if self.headers["authorization"] != "Bearer new":
+                    self.send_response(401)
+                    self.send_header("content-length", "0")
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("content-length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+        class Credentials(object):
+            token = "old"
+            refreshes = 0
+            def apply(self, headers):
+                # Same key as oauth2client's OAuth2Credentials.apply
+                headers["Authorization"] = "Bearer " + self.token
+            def refresh(self, http):
+                time.sleep(0.05)
+                self.refreshes += 1
+                self.token = "new"
+        class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+            def handle_error(self, request, client_address):
+                # The client drops the connection on a 200 at an offset
+                pass
+        server = Server(("127.0.0.1", 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            url = "http://127.0.0.1:%i/f" % server.server_port
+            credentials = Credentials()
+            results = []
+            def fetch(start):
+                stream = gdcp.DownloadStream(credentials)
+                fh = tempfile.TemporaryFile()
+                response, _ = stream.fetch(url, start, len(data) - 1, fh)
+                fh.seek(0)
+                results.append((start, gdcp.response_is_bad([response, None]),
+                    fh.read()))
+                fh.close()
+                stream.close()
+            threads = [threading.Thread(target=fetch, args=(start,))
+                for start in [0, 0, 1000, 1000]]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual(credentials.refreshes, 1)
+            self.assertListEqual(sorted(results),
+                [(0, False, data), (0, False, data), (1000, True, ""), (1000, True, "")])
+        finally:
+            server.shutdown()
+            thread.join()
+
+    def test_worker_pool(self):
+        """
+        Test that every submitted task runs with its worker's context
+        """
+        results = []
+        pool = gdcp.WorkerPool(4, init=lambda: "ctx")
+        for i in range(50):
+            pool.submit(lambda ctx, i=i: results.append((i, ctx)))
+        pool.join()
+        self.assertListEqual(sorted(results), [(i, "ctx") for i in range(50)])
+
+    def test_worker_pool_wait(self):
+        """
+        Test that wait returns once submitted tasks are done and the pool
+        can be reused
+        """
+        results = []
+        pool = gdcp.WorkerPool(3)
+        for level in range(3):
+            for i in range(10):
+                pool.submit(lambda ctx, i=i: results.append(i))
+            pool.wait()
+            self.assertEqual(len(results), 10 * (level + 1))
+        pool.join()
+
+    def test_transfer_scheduler(self):
+        """
+        Test lane split and longest-first packing of a transfer plan
+        """
+        class Options(object):
+            jobs = 4
+            segments = 2
+        class File(object):
+            def __init__(self, size):
+                self.fileSize = size
+        files = [File(s) for s in [1, 30, 2, 100, 5, 1, 1]]
+        scheduler = gdcp.TransferScheduler(Options(), large=30, rate=1, latency=0)
+        lanes = scheduler.plan(files)
+        self.assertListEqual([l.name for l in lanes], ["large", "small"])
+        self.assertListEqual([f.fileSize for f in lanes[0].files], [100, 30])
+        self.assertListEqual([f.fileSize for f in lanes[1].files], [5, 2, 1, 1, 1])
+        self.assertEqual(lanes[0].workers, 2)
+        self.assertEqual(lanes[0].seconds, 50)
+        self.assertEqual(lanes[1].seconds, 5)
+        self.assertEqual(gdcp.lpt_seconds([5, 4, 3, 3, 3], 2), 10)
+
+    def test_http_pool(self):
+        """
+        Test that worker pools check objects out of an HttpPool and that
+        later pools reuse them
+        """
+        made = []
+        def factory():
+            made.append(object())
+            return made[-1]
+        https = gdcp.HttpPool(factory)
+        for n in range(2):
+            seen = set()
+            lock = threading.Lock()
+            def task(ctx):
+                with lock:
+                    seen.add(ctx)
+            pool = gdcp.WorkerPool(3, init=https.checkout, finish=https.checkin)
+            for i in range(20):
+                pool.submit(task)
+            pool.join()
+            self.assertTrue(seen <= set(made))
+        stats = https.stats()
+        self.assertEqual(stats["created"], 3)
+        self.assertEqual(stats["reused"], 3)
+        self.assertEqual(stats["idle"], 3)
+        self.assertEqual(stats["in_use"], 0)
+
+    def test_gdcp_client(self):
+        """
+        Test that client operations get quiet Gdcp objects, run at most
+        concurrency at once on a fixed set of threads, send requests with
+        their own HTTP object and pass on results and errors
+        """
+        class Auth(object):
+            def Get_Http_Object(self):
+                return object()
+        class Drive(object):
+            auth = Auth()
+        class Request(object):
+            def execute(self, http=None):
+                return http
+        threads = threading.active_count()
+        client = gdcp.GdcpClient(Drive(), concurrency=2, jobs=3)
+        lock = threading.Lock()
+        running = [0, 0]  # now, most at once
+        release = threading.Event()
+        def task(g, i):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            release.wait(5)
+            with lock:
+                running[0] -= 1
+            return (i, g.quiet, g.jobs, gdcp.execute_request(Request()))
+        futures = [client.submit(task, i) for i in range(50)]
+        self.assertEqual(threading.active_count(), threads + 2)
+        for i in range(500):
+            if running[1] == 2:
+                break
+            time.sleep(0.01)
+        time.sleep(0.05)  # give any extra operation time to start
+        release.set()
+        results = [f.result(5) for f in futures]
+        self.assertListEqual([r[:3] for r in results], [(i, True, 3) for i in range(50)])
+        self.assertEqual(running[1], 2)
+        https = set(r[3] for r in results)
+        self.assertEqual(len(https), 2)
+        self.assertNotIn(None, https)
+        def fail(g):
+            gdcp.error("no")
+        with open(os.devnull, "w") as devnull:
+            stderr, sys.stderr = sys.stderr, devnull
+            try:
+                future = client.submit(fail)
+                self.assertIsInstance(future.exception(5), SystemExit)
+            finally:
+                sys.stderr = stderr
+        done = []
+        future.add_done_callback(done.append)
+        self.assertListEqual(done, [future])
+        client.close()
+        self.assertEqual(threading.active_count(), threads)
+        self.assertEqual(gdcp.current_http(), None)
+
 if __name__ == "__main__":
     unittest.main()